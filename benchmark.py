@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: benchmark.py
+
+"""
+micro benchmarks of the model code in train.py, every configuration runs in its own
+process so that the reported peak memory belongs to that configuration alone, ex.
+python benchmark.py attn --n_ctx 256 512 1024
+python benchmark.py recompute --n_layer 2 12 24 --recompute_every 0 1 2
+python benchmark.py allreduce --world_size 2 4 --size_mb 1 16
+python benchmark.py opt --n_layer 2 12
+python benchmark.py numpy --n_layer 2 12
+python benchmark.py frozen --n_layer 2 12
+python benchmark.py int8 --weights save/weights.npz --n_head 2 --data_dir data --encoder_path model/encoder_bpe.json --save_dir save/
+python benchmark.py shared_prefix
+python benchmark.py parity --encoder_path model/encoder_bpe_40000.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+import numpy as np
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def setup_train(**kwargs):
+    """
+    import train.py and fill in the module globals its graph functions read, from the train.py defaults
+    """
+    import train
+    args = train.get_parser().parse_args([])
+    config = dict(args.__dict__)
+    config.update(n_vocab=1000, n_special=3, lm_cutoffs=[], token_dtype=np.uint16,
+                  encoder={'_start_':1000, '_delimiter_':1001, '_classify_':1002}, clf_token=1002)
+    config.update(kwargs)
+    for k, v in config.items():
+        setattr(train, k, v)
+    return train
+
+
+def run_child(command, **kwargs):
+    cmd = [sys.executable, os.path.abspath(__file__), command]
+    for k, v in kwargs.items():
+        cmd += ['--%s' % k, str(v)]
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode('utf-8').strip().split('\n')[-1])
+
+
+def time_steps(sess, fetches, feed=None, n_steps=10, n_warmup=2, fn=None):
+    # seconds per sess.run(fetches, feed), or per fn() call
+    fn = fn or (lambda: sess.run(fetches, feed))
+    for _ in range(n_warmup):
+        fn()
+    t = time.time()
+    for _ in range(n_steps):
+        fn()
+    return (time.time()-t)/n_steps
+
+
+def attn_child(args):
+    import tensorflow as tf
+    train = setup_train(attn_impl=args.impl, attn_block=args.attn_block, attn_pdrop=0.)
+    shape = [args.n_batch, args.n_head, args.n_ctx, args.n_embd//args.n_head]
+    q = tf.Variable(np.random.randn(*shape).astype(np.float32))
+    k = tf.Variable(np.random.randn(*shape).astype(np.float32))
+    v = tf.Variable(np.random.randn(*shape).astype(np.float32))
+    a = train._attn(q, tf.transpose(k, [0, 1, 3, 2]), v, train=args.mode == 'train', scale=True)
+    # train: forward and backward, the while loops of the chunked path then keep every tile for the gradient
+    fetches = tf.gradients(tf.reduce_sum(a*a), [q, k, v]) if args.mode == 'train' else a
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    rss = peak_rss_mb()
+    step = time_steps(sess, fetches, n_steps=args.n_steps)
+    print(json.dumps(dict(impl=args.impl, mode=args.mode, n_ctx=args.n_ctx, step_ms=step*1000., peak_mb=peak_rss_mb()-rss,
+                          tokens_per_s=args.n_batch*args.n_ctx/step)))
+
+
+def attn(args):
+    print('%-8s %8s %6s %10s %12s %12s' % ('impl', 'mode', 'n_ctx', 'step_ms', 'tokens/s', 'peak_mb'))
+    for mode in args.mode:
+        for n_ctx in args.n_ctx:
+            for impl in ['dense', 'chunked']:
+                r = run_child('attn_child', impl=impl, mode=mode, n_ctx=n_ctx, n_batch=args.n_batch, n_head=args.n_head,
+                              n_embd=args.n_embd, attn_block=args.attn_block, n_steps=args.n_steps)
+                print('%-8s %8s %6d %10.1f %12.0f %12.1f' % (r['impl'], r['mode'], r['n_ctx'], r['step_ms'], r['tokens_per_s'],
+                                                             r['peak_mb']))
+
+
+def train_step_child(args):
+    # one full training step of mgpu_train on random token batches
+    import tensorflow as tf
+    train = setup_train(n_gpu=1, n_ctx=args.n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head,
+                        n_batch_train=args.n_batch, n_updates_total=1000, recompute_every=args.recompute_every)
+    X = tf.placeholder(tf.int32, [args.n_batch, 2, args.n_ctx])
+    L = tf.placeholder(tf.int32, [args.n_batch, 2])
+    Y = tf.placeholder(tf.int32, [args.n_batch])
+    ops = train.mgpu_train(X, L, Y)
+    feed = {X:np.random.randint(0, train.n_vocab, [args.n_batch, 2, args.n_ctx]),
+            L:np.full([args.n_batch, 2], args.n_ctx, dtype=np.int32),
+            Y:np.random.randint(0, 2, [args.n_batch])}
+    # mgpu_train places the towers on /gpu:i, soft placement falls back to the cpu
+    sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+    sess.run(tf.global_variables_initializer())
+    rss = peak_rss_mb()
+    step = time_steps(sess, ops[0], feed, n_steps=args.n_steps)
+    print(json.dumps(dict(n_layer=args.n_layer, recompute_every=args.recompute_every, step_ms=step*1000.,
+                          peak_mb=peak_rss_mb()-rss, tokens_per_s=args.n_batch*2*args.n_ctx/step)))
+
+
+def recompute_check(args):
+    # gradients of the classifier and LM losses with and without --recompute_every on the same variables,
+    # dropout off since the two paths draw their masks differently
+    import tensorflow as tf
+    train = setup_train(n_ctx=args.n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head,
+                        embd_pdrop=0., attn_pdrop=0., resid_pdrop=0., clf_pdrop=0.)
+    rng = np.random.RandomState(0)
+    X = tf.constant(rng.randint(0, train.n_vocab, [args.n_batch, 2, args.n_ctx]), dtype=tf.int32)
+    L = tf.constant(rng.randint(4, args.n_ctx+1, [args.n_batch, 2]), dtype=tf.int32)
+    Y = tf.constant(rng.randint(0, 2, [args.n_batch]), dtype=tf.int32)
+    loss = lambda ops: tf.reduce_mean(ops[1])+tf.reduce_mean(ops[2])
+    ref_loss = loss(train.model(X, L, Y, train=True))
+    params = train.find_trainable_variables('model')
+    ref_grads = tf.gradients(ref_loss, params)
+    train.recompute_every = args.recompute_every
+    grads = train.recompute_gradients(loss(train.model(X, L, Y, train=True, reuse=True)), params, train.recompute_segments)
+    del train.recompute_segments[:]
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    diffs = {p.name:float(np.abs(a-b).max()/(np.abs(a).max()+1e-12)) for p, a, b in
+             zip(params, *sess.run([[tf.convert_to_tensor(g) for g in ref_grads], [tf.convert_to_tensor(g) for g in grads]]))}
+    name = max(diffs, key=diffs.get)
+    print(json.dumps(dict(max_rel_diff=diffs[name], worst=name)))
+
+
+def recompute(args):
+    check = run_child('recompute_check', n_layer=2, recompute_every=1)
+    print('gradient check against --recompute_every 0: max relative diff %.2g (%s)' % (check['max_rel_diff'], check['worst']))
+    assert check['max_rel_diff'] < args.tol, 'recomputed gradients differ from the plain ones'
+    print('%8s %10s %10s %12s %12s' % ('n_layer', 'recompute', 'step_ms', 'tokens/s', 'peak_mb'))
+    for n_layer in args.n_layer:
+        for k in args.recompute_every:
+            r = run_child('train_step_child', n_layer=n_layer, recompute_every=k, n_ctx=args.n_ctx, n_batch=args.n_batch,
+                          n_head=args.n_head, n_embd=args.n_embd, n_steps=args.n_steps)
+            print('%8d %10d %10.1f %12.0f %12.1f' % (r['n_layer'], r['recompute_every'], r['step_ms'], r['tokens_per_s'], r['peak_mb']))
+
+
+def _allreduce_worker(rank, world_size, n, port, n_steps, out):
+    from dist import Ring
+    ring = Ring(rank, world_size, port=port)
+    x = np.random.RandomState(rank).randn(n).astype(np.float32)
+    expected = sum(np.random.RandomState(r).randn(n).astype(np.float32) for r in range(world_size))
+    y = ring.allreduce(x.copy())
+    ok = bool(np.allclose(y, expected, atol=1e-4))
+    b = ring.broadcast(x.copy())
+    ok = ok and bool(np.array_equal(b, np.random.RandomState(0).randn(n).astype(np.float32)))
+    ring.barrier()
+    t = time.time()
+    for _ in range(n_steps):
+        ring.allreduce(x)
+    out.put((rank, ok, (time.time()-t)/n_steps))
+    ring.close()
+
+
+def allreduce(args):
+    # every configuration checks the ring sum and broadcast against numpy before timing it
+    print('%10s %8s %10s %10s %6s' % ('world_size', 'size_mb', 'step_ms', 'bus_gb/s', 'ok'))
+    for world_size in args.world_size:
+        for size_mb in args.size_mb:
+            n = int(size_mb*(1<<20))//4
+            out = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=_allreduce_worker, args=(r, world_size, n, args.port, args.n_steps, out))
+                     for r in range(world_size)]
+            for p in procs:
+                p.start()
+            results = [out.get() for _ in procs]
+            for p in procs:
+                p.join()
+            step = max(r[2] for r in results)
+            # bytes every worker moves in a ring allreduce
+            bus = 2.*(world_size-1)/world_size*n*4/step/1e9
+            print('%10d %8.1f %10.2f %10.2f %6s' % (world_size, size_mb, step*1000., bus, all(r[1] for r in results)))
+
+
+def opt_child(args):
+    # adam and fused_adam from the same start on the parameters of the model, with fixed gradients
+    import tensorflow as tf
+    from opt import adam, fused_adam, warmup_linear
+    train = setup_train(n_ctx=args.n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head)
+    X = tf.placeholder(tf.int32, [1, 2, args.n_ctx])
+    L = tf.placeholder(tf.int32, [1, 2])
+    train.model(X, L, train=True)
+    params = train.find_trainable_variables('model')
+    fns = dict(adam=adam, fused_adam=fused_adam)
+    rng = np.random.RandomState(0)
+    grads = [tf.constant(rng.randn(*p.get_shape().as_list()).astype(np.float32)) for p in params]
+    copies, updates = {}, {}
+    for name, fn in fns.items():
+        with tf.variable_scope(name):
+            copies[name] = [tf.Variable(p.initialized_value()) for p in params]
+            updates[name] = fn(copies[name], grads, train.lr, warmup_linear, 1000, l2=train.l2, max_grad_norm=train.max_grad_norm,
+                               vector_l2=train.vector_l2, b1=train.b1, b2=train.b2, e=train.e)
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    for _ in range(args.n_check):
+        sess.run([updates['adam'], updates['fused_adam']])
+    a, f = sess.run([copies['adam'], copies['fused_adam']])
+    max_diff = max(float(np.abs(x-y).max()) for x, y in zip(a, f))
+    step = {name:time_steps(sess, updates[name], n_steps=args.n_steps) for name in fns}
+    print(json.dumps(dict(n_layer=args.n_layer, n_params=int(sum(np.prod(p.get_shape().as_list()) for p in params)),
+                          adam_ms=step['adam']*1000., fused_ms=step['fused_adam']*1000., max_diff=max_diff)))
+
+
+def opt(args):
+    print('%8s %10s %10s %10s %10s' % ('n_layer', 'n_params', 'adam_ms', 'fused_ms', 'max_diff'))
+    for n_layer in args.n_layer:
+        r = run_child('opt_child', n_layer=n_layer, n_ctx=args.n_ctx, n_head=args.n_head, n_embd=args.n_embd,
+                      n_steps=args.n_steps, n_check=args.n_check)
+        print('%8d %10d %10.2f %10.2f %10.2g' % (r['n_layer'], r['n_params'], r['adam_ms'], r['fused_ms'], r['max_diff']))
+
+
+def build_checkpoint(args, path):
+    # random weights of the model saved like train.py does, plus a random batch and its logits from the tf graph
+    import tensorflow as tf
+    train = setup_train(n_ctx=args.n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head)
+    X = tf.placeholder(tf.int32, [None, 2, None])
+    L = tf.placeholder(tf.int32, [None, 2])
+    logits = train.model(X, L, train=False, lm=False)[0]
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    tf.train.Saver({v.name:v for v in tf.trainable_variables()}).save(sess, path, write_meta_graph=False)
+    rng = np.random.RandomState(0)
+    lmb = rng.randint(4, args.n_ctx+1, [args.n_batch, 2]).astype(np.int32)
+    xmb = rng.randint(0, train.n_vocab, [args.n_batch, 2, args.n_ctx]).astype(np.int32)
+    np.savez(path + '.batch.npz', xmb=xmb, lmb=lmb, logits=sess.run(logits, {X:xmb, L:lmb}))
+
+
+def startup_child(args):
+    # seconds from a bare process to the first batch of logits, and per batch after that
+    t = time.time()
+    batch = np.load(args.checkpoint + '.batch.npz')
+    xmb, lmb = batch['xmb'], batch['lmb']
+    if args.impl == 'tf':
+        import tensorflow as tf
+        train = setup_train(n_ctx=args.n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head)
+        X = tf.placeholder(tf.int32, [None, 2, None])
+        L = tf.placeholder(tf.int32, [None, 2])
+        logits = train.model(X, L, train=False, lm=False)[0]
+        sess = tf.Session()
+        tf.train.Saver({v.name:v for v in tf.trainable_variables()}).restore(sess, args.checkpoint)
+        fn = lambda: sess.run(logits, {X:xmb, L:lmb})
+    elif args.impl == 'frozen':
+        from freeze import FrozenModel
+        model = FrozenModel(args.checkpoint + '.pb')
+        fn = lambda: model.logits(xmb, lmb)
+    else:
+        from inference import NumpyModel
+        model = NumpyModel.from_checkpoint(args.checkpoint + '.npz', n_head=args.n_head, n_vocab=1000)
+        fn = lambda: model.logits(xmb, lmb)
+    load = time.time()-t
+    out = fn()
+    startup = time.time()-t
+    latency = time_steps(None, None, n_steps=args.n_steps, n_warmup=0, fn=fn)
+    print(json.dumps(dict(impl=args.impl, load_s=load, first_batch_s=startup-load, startup_s=startup,
+                          latency_ms=latency*1000., peak_mb=peak_rss_mb(), max_diff=float(np.abs(out-batch['logits']).max()))))
+
+
+def numpy_bench(args):
+    print('%8s %6s %10s %12s %10s %10s' % ('n_layer', 'impl', 'startup_s', 'latency_ms', 'peak_mb', 'max_diff'))
+    for n_layer in args.n_layer:
+        path = os.path.join(tempfile.mkdtemp(), 'model')
+        run_child('checkpoint_child', path=path, n_layer=n_layer, n_ctx=args.n_ctx, n_head=args.n_head, n_embd=args.n_embd,
+                  n_batch=args.n_batch)
+        for impl in ['tf', 'numpy']:
+            r = run_child('startup_child', impl=impl, checkpoint=path, n_layer=n_layer, n_ctx=args.n_ctx, n_head=args.n_head,
+                          n_embd=args.n_embd, n_steps=args.n_steps)
+            print('%8d %6s %10.2f %12.2f %10.1f %10.2g' % (n_layer, r['impl'], r['startup_s'], r['latency_ms'], r['peak_mb'], r['max_diff']))
+        if args.tol > 0:
+            assert r['max_diff'] < args.tol, 'numpy logits differ from the tf graph by %g' % r['max_diff']
+
+
+def freeze_child(args):
+    # the frozen graph of the checkpoint as freeze.py writes it, at <checkpoint>.pb
+    import tensorflow as tf
+    from freeze import freeze, write_frozen
+    train = setup_train(n_ctx=args.n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head, attn_impl='dense')
+    X = tf.placeholder(tf.int32, [None, 2, args.n_ctx])
+    L = tf.placeholder(tf.int32, [None, 2])
+    logits = train.model(X, L, train=False, lm=False)[0]
+    sess = tf.Session()
+    tf.train.Saver({v.name:v for v in tf.trainable_variables()}).restore(sess, args.checkpoint)
+    graph_def = freeze(sess, [X, L], [logits])
+    write_frozen(graph_def, args.checkpoint + '.pb', [X, L], [logits], n_seq=args.n_ctx)
+    print(json.dumps(dict(n_nodes=len(sess.graph.as_graph_def().node), n_frozen_nodes=len(graph_def.node))))
+
+
+def frozen(args):
+    print('%8s %6s %8s %10s %14s %12s %10s %10s' % ('n_layer', 'impl', 'nodes', 'load_s', 'first_batch_s', 'latency_ms',
+                                                    'peak_mb', 'max_diff'))
+    for n_layer in args.n_layer:
+        path = os.path.join(tempfile.mkdtemp(), 'model')
+        config = dict(n_layer=n_layer, n_ctx=args.n_ctx, n_head=args.n_head, n_embd=args.n_embd)
+        run_child('checkpoint_child', path=path, n_batch=args.n_batch, **config)
+        nodes = run_child('freeze_child', checkpoint=path, **config)
+        for impl, n_nodes in [('tf', nodes['n_nodes']), ('frozen', nodes['n_frozen_nodes'])]:
+            r = run_child('startup_child', impl=impl, checkpoint=path, n_steps=args.n_steps, **config)
+            print('%8d %6s %8d %10.2f %14.3f %12.2f %10.1f %10.2g' % (n_layer, impl, n_nodes, r['load_s'], r['first_batch_s'],
+                                                                      r['latency_ms'], r['peak_mb'], r['max_diff']))
+        if args.tol > 0:
+            assert r['max_diff'] < args.tol, 'frozen graph logits differ from the tf graph by %g' % r['max_diff']
+
+
+def shared_prefix(args):
+    """
+    --shared_prefix against the per-candidate model on the same variables, in a batch whose longest question and
+    longest answer come from different examples and n_ctx cut to the longest sequence, as train.py cuts it, so the
+    suffix positions of the long question row run past n_ctx. logits and LM losses have to agree within --tol
+    """
+    import tensorflow as tf
+    from text_utils import RaggedTokens
+    max_len = args.max_len_ctx//2-2
+    rng = np.random.RandomState(0)
+    lengths = [(args.n_long, 1, 1), (1, args.n_long, args.n_long//2)]
+    lengths += [tuple(rng.randint(1, args.n_long+1, 3)) for _ in range(args.n_examples-2)]
+    ragged = []
+    for col in zip(*lengths):
+        offsets = np.concatenate([[0], np.cumsum(col)]).astype(np.int64)
+        ragged.append(RaggedTokens(rng.randint(0, 1000, offsets[-1]).astype(np.int32), offsets))
+    n_ctx = max(l1+max(l2, l3) for l1, l2, l3 in lengths)+3
+    train = setup_train(n_ctx=n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head, max_len=max_len,
+                        token_dtype=np.int32, shared_prefix=False)
+    xmb, lmb = train.transform_roc(*ragged)
+    X = tf.placeholder(tf.int32, [None, 2, n_ctx])
+    L = tf.placeholder(tf.int32, [None, 2])
+    ref_logits, _, ref_lm = train.model(X, L, train=False)
+    train.shared_prefix = True
+    logits, _, lm = train.model(X, L, train=False, reuse=True)
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    ref_logits, ref_lm, logits, lm = sess.run([ref_logits, ref_lm, logits, lm], {X:xmb, L:lmb})
+    max_diff = max(float(np.abs(ref_logits-logits).max()), float(np.abs(ref_lm-lm).max()))
+    lp = np.array([l1 for l1, _, _ in lengths])+2
+    # position of the last padded suffix token of the row with the longest prefix
+    last = lp.max()+(lmb-lp[:, None]).max()-1
+    print('n_ctx %d, last suffix position %d: max logit/LM loss diff %.2g' % (n_ctx, last, max_diff))
+    assert max_diff < args.tol, '--shared_prefix differs from the per-candidate model by %g' % max_diff
+
+
+def parity(args):
+    """
+    the numpy engine against the tf graph on the same texts, one side through transform_roc and model(), the other
+    through Scorer and NumpyModel. the run is one whose n_ctx was cut to its data (n_ctx) below the n_ctx that set
+    its max_len (max_len_ctx), so answers longer than (n_ctx-3)//2 are kept. the logits have to agree within --tol
+    """
+    import random
+    import tensorflow as tf
+    from inference import NumpyModel, Scorer
+    from text_utils import TextEncoder
+    text_encoder = TextEncoder(args.encoder_path)
+    n_vocab = len(text_encoder.encoder)
+    max_len = args.max_len_ctx//2-2
+    train = setup_train(n_ctx=args.n_ctx, n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head, n_vocab=n_vocab,
+                        max_len=max_len, token_dtype=np.int32, clf_token=n_vocab+2,
+                        encoder={'_start_':n_vocab, '_delimiter_':n_vocab+1, '_classify_':n_vocab+2})
+    rng = random.Random(0)
+    chars = [c for c in text_encoder.encoder if len(c) == 1]
+    text = lambda n: ''.join(rng.choice(chars) for _ in range(n))
+    # every example fits the n_ctx of the run, as the training data did
+    questions = [text(rng.randint(1, args.n_ctx//4)) for _ in range(args.n_examples)]
+    answers1, answers2 = [[text(rng.randint(1, args.n_ctx-3-len(q))) for q in questions] for _ in range(2)]
+    X1, X2, X3 = [text_encoder.encode_ragged(texts, verbose=False) for texts in (questions, answers1, answers2)]
+    xmb, lmb = train.transform_roc(X1, X2, X3)
+    X = tf.placeholder(tf.int32, [None, 2, args.n_ctx])
+    L = tf.placeholder(tf.int32, [None, 2])
+    logits = train.model(X, L, train=False, lm=False)[0]
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    tf_logits = sess.run(logits, {X:xmb, L:lmb})
+    weights = dict(zip([v.name for v in tf.global_variables()], sess.run(tf.global_variables())))
+    model = NumpyModel(weights, n_head=args.n_head, n_vocab=n_vocab, afn=train.afn)
+    np_logits = Scorer(model, text_encoder, max_len).score(questions, answers1, answers2)
+    max_diff = float(np.abs(tf_logits-np_logits).max())
+    agree = float(np.mean(np.argmax(tf_logits, 1) == np.argmax(np_logits, 1))*100.)
+    print('%d examples, max len %d: max logit diff %.2g , prediction agreement %.2f%%' % (len(lmb), lmb.max(), max_diff, agree))
+    assert max_diff < args.tol, 'numpy logits differ from the tf graph by %g' % max_diff
+
+
+def checkpoint_child(args):
+    from inference import export_weights
+    build_checkpoint(args, args.path)
+    export_weights(args.path, args.path + '.npz')
+    print(json.dumps(dict(path=args.path)))
+
+
+def int8_child(args):
+    # one weight format per process, loaded as stored, so that peak_mb is its own
+    from inference import NumpyModel, Scorer, load_weights
+    from text_utils import TextEncoder
+    weights = load_weights(args.weights)
+    text_encoder = TextEncoder(args.encoder_path) if args.encoder_path else None
+    n_vocab = len(text_encoder.encoder) if text_encoder else args.n_vocab
+    model = NumpyModel(weights, n_head=args.n_head, n_vocab=n_vocab, afn=args.afn)
+    del weights
+    r = dict(impl=args.impl, weight_mb=model.nbytes/2.**20)
+    if args.data_dir:
+        # validation accuracy as log() computes it, the texts cut with the max_len of the run
+        from datasets import data_process
+        assert args.save_dir, '--save_dir of the run is needed for its manifest.json'
+        with open(os.path.join(args.save_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        # the answer order of the validation split depends on the seed of the run
+        _, (vaX1, vaX2, vaX3, vaY), _ = data_process(args.data_dir, seed=manifest['args']['seed'])
+        scorer = Scorer(model, text_encoder, manifest['max_len'])
+        t = time.time()
+        logits = scorer.score(vaX1, vaX2, vaX3, n_batch=args.n_batch)
+        r.update(va_acc=float(np.mean(np.argmax(logits, 1) == vaY)*100.), examples_per_s=len(vaY)/(time.time()-t))
+        np.save(args.out, logits)
+    else:
+        rng = np.random.RandomState(0)
+        lmb = rng.randint(4, model.n_ctx+1, [args.n_batch, 2]).astype(np.int32)
+        xmb = rng.randint(0, n_vocab, [args.n_batch, 2, model.n_ctx]).astype(np.int32)
+        step = time_steps(None, None, n_steps=args.n_steps, fn=lambda: model.logits(xmb, lmb))
+        r.update(examples_per_s=args.n_batch/step)
+        np.save(args.out, model.logits(xmb, lmb))
+    r['peak_mb'] = peak_rss_mb()
+    print(json.dumps(r))
+
+
+def int8(args):
+    """
+    the float32 weights and their int8 quantization side by side, with --data_dir the validation accuracy as log()
+    computes it, with --save_dir the results are also appended to save_dir/int8_report.jsonl
+    """
+    from inference import load_weights, quantize_weights
+    tmp_dir = tempfile.mkdtemp()
+    weights = {'float32':args.weights, 'int8':os.path.join(tmp_dir, 'weights_int8.npz')}
+    np.savez(weights['int8'], **quantize_weights(load_weights(args.weights)))
+    print('%6s %10s %10s %14s %10s' % ('impl', 'weight_mb', 'peak_mb', 'examples/s', 'va_acc'))
+    logits, results = {}, []
+    for impl in ['float32', 'int8']:
+        out = os.path.join(tmp_dir, impl + '.npy')
+        kwargs = {k:v for k, v in args.__dict__.items() if k not in ('command', 'weights') and v is not None}
+        r = run_child('int8_child', impl=impl, weights=weights[impl], out=out, **kwargs)
+        logits[impl] = np.load(out)
+        results.append(r)
+        print('%6s %10.1f %10.1f %14.1f %10s' % (impl, r['weight_mb'], r['peak_mb'], r['examples_per_s'],
+                                                 '%.2f' % r['va_acc'] if 'va_acc' in r else '-'))
+    agree = float(np.mean(np.argmax(logits['float32'], 1) == np.argmax(logits['int8'], 1))*100.)
+    max_diff = float(np.abs(logits['float32']-logits['int8']).max())
+    print('prediction agreement: %.2f%% , max logit diff: %.4f' % (agree, max_diff))
+    if args.save_dir:
+        with open(os.path.join(args.save_dir, 'int8_report.jsonl'), 'a') as f:
+            f.write(json.dumps(dict(weights=args.weights, results=results, agreement=agree, max_diff=max_diff, time=time.time()))+'\n')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('attn')
+    p.add_argument('--mode', type=str, nargs='+', default=['forward', 'train'])
+    p.add_argument('--n_ctx', type=int, nargs='+', default=[256, 512, 1024])
+    p.add_argument('--n_batch', type=int, default=8)
+    p.add_argument('--n_head', type=int, default=2)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--attn_block', type=int, default=64)
+    p.add_argument('--n_steps', type=int, default=10)
+    p = sub.add_parser('attn_child')
+    p.add_argument('--impl', type=str, default='dense')
+    p.add_argument('--mode', type=str, default='train')
+    p.add_argument('--n_ctx', type=int, default=256)
+    p.add_argument('--n_batch', type=int, default=8)
+    p.add_argument('--n_head', type=int, default=2)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--attn_block', type=int, default=64)
+    p.add_argument('--n_steps', type=int, default=10)
+
+    p = sub.add_parser('recompute')
+    # the train.py defaults, deeper stacks of them
+    p.add_argument('--n_layer', type=int, nargs='+', default=[2, 12, 24])
+    p.add_argument('--recompute_every', type=int, nargs='+', default=[0, 1, 2])
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_batch', type=int, default=8)
+    p.add_argument('--n_head', type=int, default=2)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--n_steps', type=int, default=5)
+    p.add_argument('--tol', type=float, default=1e-4)
+    p = sub.add_parser('recompute_check')
+    p.add_argument('--n_layer', type=int, default=2)
+    p.add_argument('--recompute_every', type=int, default=1)
+    p.add_argument('--n_ctx', type=int, default=16)
+    p.add_argument('--n_batch', type=int, default=2)
+    p.add_argument('--n_head', type=int, default=2)
+    p.add_argument('--n_embd', type=int, default=16)
+    p = sub.add_parser('train_step_child')
+    p.add_argument('--n_layer', type=int, default=12)
+    p.add_argument('--recompute_every', type=int, default=0)
+    p.add_argument('--n_ctx', type=int, default=128)
+    p.add_argument('--n_batch', type=int, default=4)
+    p.add_argument('--n_head', type=int, default=12)
+    p.add_argument('--n_embd', type=int, default=768)
+    p.add_argument('--n_steps', type=int, default=5)
+
+    p = sub.add_parser('opt')
+    p.add_argument('--n_layer', type=int, nargs='+', default=[2, 12])
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--n_steps', type=int, default=50)
+    p.add_argument('--n_check', type=int, default=10)
+    p = sub.add_parser('opt_child')
+    p.add_argument('--n_layer', type=int, default=2)
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--n_steps', type=int, default=50)
+    p.add_argument('--n_check', type=int, default=10)
+
+    p = sub.add_parser('numpy')
+    p.add_argument('--n_layer', type=int, nargs='+', default=[2, 12])
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--n_batch', type=int, default=8)
+    p.add_argument('--n_steps', type=int, default=20)
+    p.add_argument('--tol', type=float, default=1e-4)
+    p = sub.add_parser('shared_prefix')
+    p.add_argument('--n_examples', type=int, default=8)
+    p.add_argument('--n_long', type=int, default=30)
+    p.add_argument('--max_len_ctx', type=int, default=512)
+    p.add_argument('--n_layer', type=int, default=2)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=64)
+    p.add_argument('--tol', type=float, default=1e-4)
+    p = sub.add_parser('parity')
+    p.add_argument('--encoder_path', type=str, default='model/encoder_bpe_40000.json')
+    p.add_argument('--n_examples', type=int, default=64)
+    p.add_argument('--n_layer', type=int, default=2)
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--max_len_ctx', type=int, default=512)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=64)
+    p.add_argument('--tol', type=float, default=1e-4)
+    p = sub.add_parser('checkpoint_child')
+    p.add_argument('--path', type=str, required=True)
+    p.add_argument('--n_layer', type=int, default=2)
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--n_batch', type=int, default=8)
+    p = sub.add_parser('frozen')
+    p.add_argument('--n_layer', type=int, nargs='+', default=[2, 12])
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--n_batch', type=int, default=8)
+    p.add_argument('--n_steps', type=int, default=20)
+    p.add_argument('--tol', type=float, default=1e-4)
+    p = sub.add_parser('freeze_child')
+    p.add_argument('--checkpoint', type=str, required=True)
+    p.add_argument('--n_layer', type=int, default=2)
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=128)
+    p = sub.add_parser('startup_child')
+    p.add_argument('--impl', type=str, default='numpy')
+    p.add_argument('--checkpoint', type=str, required=True)
+    p.add_argument('--n_layer', type=int, default=2)
+    p.add_argument('--n_ctx', type=int, default=64)
+    p.add_argument('--n_head', type=int, default=4)
+    p.add_argument('--n_embd', type=int, default=128)
+    p.add_argument('--n_steps', type=int, default=20)
+
+    for name in ['int8', 'int8_child']:
+        p = sub.add_parser(name)
+        p.add_argument('--weights', type=str, required=True)
+        p.add_argument('--n_head', type=int, default=2)
+        p.add_argument('--afn', type=str, default='gelu')
+        p.add_argument('--n_vocab', type=int, default=1000)
+        p.add_argument('--encoder_path', type=str)
+        p.add_argument('--data_dir', type=str)
+        p.add_argument('--save_dir', type=str)
+        p.add_argument('--n_batch', type=int, default=32)
+        p.add_argument('--n_steps', type=int, default=10)
+    p.add_argument('--impl', type=str, default='float32')
+    p.add_argument('--out', type=str, required=True)
+
+    p = sub.add_parser('allreduce')
+    p.add_argument('--world_size', type=int, nargs='+', default=[2, 4])
+    p.add_argument('--size_mb', type=float, nargs='+', default=[1, 16])
+    p.add_argument('--port', type=int, default=29500)
+    p.add_argument('--n_steps', type=int, default=10)
+    return parser
+
+
+commands = {
+    'attn':attn,
+    'attn_child':attn_child,
+    'recompute':recompute,
+    'recompute_check':recompute_check,
+    'train_step_child':train_step_child,
+    'allreduce':allreduce,
+    'opt':opt,
+    'opt_child':opt_child,
+    'numpy':numpy_bench,
+    'shared_prefix':shared_prefix,
+    'parity':parity,
+    'checkpoint_child':checkpoint_child,
+    'startup_child':startup_child,
+    'frozen':frozen,
+    'freeze_child':freeze_child,
+    'int8':int8,
+    'int8_child':int8_child,
+}
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    commands[args.command](args)
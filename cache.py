@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: cache.py
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from text_utils import RaggedTokens
+
+
+def file_digest(path, chunk_size=1<<20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(paths, **params):
+    """
+    key of a cache entry: content hashes of the input files plus the parameters used to build it
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        h.update(file_digest(path).encode('utf-8'))
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def save_arrays(cache_dir, key, arrays, meta=None):
+    """
+    write {name: np.ndarray or RaggedTokens} as .npy files plus a meta.json, the entry only becomes visible once complete
+    """
+    ragged = sorted(name for name, array in arrays.items() if isinstance(array, RaggedTokens))
+    flat = {}
+    for name, array in arrays.items():
+        if name in ragged:
+            flat[name + '.tokens'] = array.tokens
+            flat[name + '.offsets'] = array.offsets
+        else:
+            flat[name] = array
+    path = os.path.join(cache_dir, key)
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, array in flat.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(array))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'arrays':sorted(flat), 'ragged':ragged, 'meta':meta or {}}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run, e.g. another rank on the same machine, filled the same entry in the meantime
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(tmp_path)
+    return path
+
+
+def load_arrays(cache_dir, key, mmap_mode='r'):
+    """
+    reopen a cache entry memory-mapped, returns (arrays, meta) or None on a miss
+    """
+    path = os.path.join(cache_dir, key)
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        info = json.load(f)
+    arrays = {name:np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in info['arrays']}
+    for name in info.get('ragged', []):
+        arrays[name] = RaggedTokens(arrays.pop(name + '.tokens'), arrays.pop(name + '.offsets'))
+    return arrays, info['meta']
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: checkpoint.py
+
+import os
+import json
+import glob
+import queue
+import shutil
+import threading
+import tensorflow as tf
+
+
+class CheckpointWriter(object):
+    """
+    tf.train.Saver compatible checkpoints written off the training thread:
+    save() copies the variables to host memory and returns, a background thread writes the copy
+    through a saver of its own graph into a temporary directory, moves the files into place and
+    only then points the checkpoint state file at them. The last max_to_keep checkpoints and the
+    best one are kept, older ones are deleted.
+    var_list: {checkpoint name: variable}, as given to tf.train.Saver
+    a json dict of training state can be published with every checkpoint, next to it as <path>.state.json
+    best: the best checkpoint of a resumed run (recorded in its training state), kept out of the rotation
+    """
+
+    def __init__(self, var_list, save_dir, max_to_keep=5, best=None):
+        self.names = sorted(var_list)
+        self.variables = [var_list[name] for name in self.names]
+        self.save_dir = save_dir
+        self.max_to_keep = max_to_keep
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.shadows = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), trainable=False)
+                            for v in self.variables]
+            self.saver = tf.train.Saver(dict(zip(self.names, self.shadows)), max_to_keep=None)
+        self.sess = tf.Session(graph=self.graph)
+        state = tf.train.get_checkpoint_state(save_dir)
+        self.best = best
+        self.kept = [p for p in state.all_model_checkpoint_paths if p != best] if state else []
+        self.error = None
+        # one snapshot waiting at most, a save while it waits blocks instead of piling up copies in memory
+        self.queue = queue.Queue(1)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, sess, path, global_step=None, best=False, state=None):
+        """
+        snapshot the variables of sess for a checkpoint at path[-global_step], written in the background
+        best: the checkpoint is kept as the best one instead of taking part in the rotation
+        state: json serializable dict saved along, see load_state
+        """
+        self._check()
+        if global_step is not None:
+            path = '%s-%d' % (path, global_step)
+        values = sess.run(self.variables)
+        self.queue.put((path, values, best, json.dumps(state) if state is not None else None))
+        return path
+
+    def wait(self):
+        # block until every snapshot taken so far is on disk
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+        self.sess.close()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('checkpoint writer failed: %r' % self.error)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, path, values, best, state):
+        for shadow, value in zip(self.shadows, values):
+            shadow.load(value, self.sess)
+        tmp_dir = os.path.join(self.save_dir, '.tmp-%s' % os.path.basename(path))
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        self.saver.save(self.sess, os.path.join(tmp_dir, os.path.basename(path)), write_meta_graph=False, write_state=False)
+        if state is not None:
+            with open(os.path.join(tmp_dir, os.path.basename(path) + '.state.json'), 'w') as f:
+                f.write(state)
+        # the files get their final names once complete, the state file is updated last (atomically by tensorflow)
+        for f in os.listdir(tmp_dir):
+            os.rename(os.path.join(tmp_dir, f), os.path.join(os.path.dirname(path), f))
+        os.rmdir(tmp_dir)
+
+        stale = []
+        if best:
+            if self.best not in (None, path):
+                stale.append(self.best)
+            self.best = path
+        else:
+            self.kept = [p for p in self.kept if p != path]+[path]
+            if self.max_to_keep > 0 and len(self.kept) > self.max_to_keep:
+                stale += self.kept[:-self.max_to_keep]
+                self.kept = self.kept[-self.max_to_keep:]
+        # the checkpoint just written has to come last, tensorflow appends it again otherwise
+        paths = [p for p in ([self.best] if self.best else [])+self.kept if p != path]+[path]
+        tf.train.update_checkpoint_state(self.save_dir, path, all_model_checkpoint_paths=paths)
+        # only files the state no longer mentions are deleted
+        for p in stale:
+            if p not in paths:
+                self._delete(p)
+
+    def _delete(self, path):
+        for f in glob.glob(path + '.*'):
+            os.remove(f)
+
+
+def load_state(path):
+    # training state saved with the checkpoint at path, None for checkpoints written without one
+    state_path = path + '.state.json'
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        return json.load(f)
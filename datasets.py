@@ -8,65 +8,128 @@ import os
 import csv
 import numpy as np
 import json
-from tqdm import tqdm
 import random
-import codecs
+from multiprocessing import Pool
 
 seed = 3535999445
 
 
-def _data_process(path):
-    f = codecs.open(path, 'r', encoding='utf-8')
+def _line_shards(path, n_shards):
+    """
+    split a file into n_shards byte ranges [start, end) that begin and end on line boundaries
+    """
+    size = os.path.getsize(path)
+    step = max(size//max(n_shards, 1), 1)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            # seek one byte back so a line starting exactly at i*step is not skipped
+            f.seek(max(i*step-1, bounds[-1]))
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
 
-    st = []
-    ct1 = []
-    y = []
 
-    for line in f:
-        data = json.loads(line)
-        ans = '。'.join(data["answer"].strip().split())
-        desc = '。'.join(data["desc"].strip().split())
-        if desc != '' and ans != '':
-            st.append(desc)
-            ct1.append(ans)
-    ct2 = ct1[1:] + [ct1[0]]
+def _parse_shard(shard):
+    path, start, end = shard
+    pairs = []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            if not line.strip():
+                continue
+            data = json.loads(line.decode('utf-8'))
+            ans = '。'.join(data["answer"].strip().split())
+            desc = '。'.join(data["desc"].strip().split())
+            if desc != '' and ans != '':
+                pairs.append((desc, ans))
+    return pairs
 
-    assert len(ct1) == len(ct2)
-    for i in range(len(ct1)):
-        rand = random.random()
-        if rand <= 0.5:
-            y.append(0)
+
+def iter_qa(path, n_proc=None):
+    """
+    stream (desc, answer) pairs of a jsonl file in file order, parsed by a pool of n_proc workers
+    """
+    n_proc = n_proc or os.cpu_count() or 1
+    if n_proc == 1:
+        for pair in _parse_shard((path, 0, os.path.getsize(path))):
+            yield pair
+        return
+    # a few shards per worker keeps the pool busy when line lengths are uneven
+    shards = _line_shards(path, n_proc*4)
+    with Pool(n_proc) as pool:
+        for pairs in pool.imap(_parse_shard, shards):
+            for pair in pairs:
+                yield pair
+
+
+def _iter_pairs(path, n_proc=None):
+    # (question, answer, wrong answer): the wrong answer of example i is the answer of example i+1, the last one
+    # wraps around to the first
+    first = None
+    prev = None
+    for desc, ans in iter_qa(path, n_proc=n_proc):
+        if prev is None:
+            first = ans
         else:
-            y.append(1)
-            s1 = ct1[i]
-            s2 = ct2[i]
-            ct1[i] = s2
-            ct2[i] = s1
+            yield prev[0], prev[1], ans
+        prev = (desc, ans)
+    if prev is not None:
+        yield prev[0], prev[1], first
+
 
+def _data_process(triples, rng):
+    # one rng draw per example decides which of the two answers comes first
+    st, ct1, ct2, y = [], [], [], []
+    for s, right, wrong in triples:
+        if rng.random() <= 0.5:
+            c1, c2, label = right, wrong, 0
+        else:
+            c1, c2, label = wrong, right, 1
+        st.append(s)
+        ct1.append(c1)
+        ct2.append(c2)
+        y.append(label)
     return st, ct1, ct2, y
 
 
-def data_process(data_dir):
-    tr_q, tr_a1, tr_a2, tr_ys = _data_process(os.path.join(data_dir, 'baike_qa_train.json'))
-    va_q, va_a1, va_a2, va_ys = _data_process(os.path.join(data_dir, 'baike_qa_test.json'))
-    teX1, teX2, teX3, _ = _data_process(os.path.join(data_dir, 'baike_qa_test.json'))
-
-    trX1, trX2, trX3 = [], [], []
-    trY = []
-    for s, c1, c2, y in zip(tr_q, tr_a1, tr_a2, tr_ys):
-        trX1.append(s)
-        trX2.append(c1)
-        trX3.append(c2)
-        trY.append(y)
-
-    vaX1, vaX2, vaX3 = [], [], []
-    vaY = []
-    for s, c1, c2, y in zip(va_q, va_a1, va_a2, va_ys ):
-        vaX1.append(s)
-        vaX2.append(c1)
-        vaX3.append(c2)
-        vaY.append(y)
+def data_process(data_dir, seed=seed, n_proc=None):
+    """
+    the parsing streams (see iter_qa), the columns are lists since encode_dataset encodes every text of a split at once.
+    seed: the answer order of the train, validation and test splits is drawn from random.Random(seed) in that order,
+    as random.random() after train.py's random.seed(seed) did
+    """
+    rng = random.Random(seed)
+    trX1, trX2, trX3, trY = _data_process(_iter_pairs(os.path.join(data_dir, 'baike_qa_train.json'), n_proc=n_proc), rng)
+    # validation and test are both made from baike_qa_test.json, which is parsed once, with answer orders of their own
+    te_triples = list(_iter_pairs(os.path.join(data_dir, 'baike_qa_test.json'), n_proc=n_proc))
+    vaX1, vaX2, vaX3, vaY = _data_process(te_triples, rng)
+    teX1, teX2, teX3, _ = _data_process(te_triples, rng)
+
     trY = np.asarray(trY, dtype=np.int32)
     vaY = np.asarray(vaY, dtype=np.int32)
     return (trX1, trX2, trX3, trY), (vaX1, vaX2, vaX3, vaY), (teX1, teX2, teX3)
     # (trX1, trX2, trX3, trY) = ([sentence1, sentence2...],[quiz1_1, quiz1_2....],[quiz2_1, quiz2_2...],[0,1,1,0.....])
+
+
+def test_data_process(data_dir, n_train, seed=seed, n_proc=None):
+    """
+    the test split of data_process without parsing the training file: the answer order only depends on the rng,
+    which is advanced past the one draw per training and validation example data_process makes first
+    """
+    rng = random.Random(seed)
+    te_triples = list(_iter_pairs(os.path.join(data_dir, 'baike_qa_test.json'), n_proc=n_proc))
+    for _ in range(n_train+len(te_triples)):
+        rng.random()
+    teX1, teX2, teX3, _ = _data_process(te_triples, rng)
+    return teX1, teX2, teX3
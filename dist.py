@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: dist.py
+
+"""
+multi-process data parallelism without any device assumptions: the workers form a ring of tcp
+connections and sum flat float32 buffers with a ring allreduce, ex. 4 workers on one machine
+for r in 0 1 2 3; do python train.py --dist_world_size 4 --dist_rank $r & done
+and one worker per node with --dist_hosts host0,host1,...
+"""
+
+import socket
+import threading
+import time
+import numpy as np
+
+
+def _connect(host, port, timeout=600.):
+    # the next worker may not be listening yet
+    deadline = time.time()+timeout
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except (ConnectionRefusedError, OSError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _bytes(x):
+    return memoryview(x).cast('B')
+
+
+class Ring(object):
+    """
+    worker rank of world_size, connected to its neighbours: it sends to rank+1 and receives from rank-1,
+    worker i listens on hosts[i]:port+i
+    """
+
+    def __init__(self, rank, world_size, hosts=None, port=29500):
+        self.rank = rank
+        self.world_size = world_size
+        if world_size == 1:
+            return
+        hosts = hosts or ['127.0.0.1']*world_size
+        assert len(hosts) == world_size, 'one host per rank'
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('', port+rank))
+        server.listen(1)
+        nxt = (rank+1) % world_size
+        self.send_sock = _connect(hosts[nxt], port+nxt)
+        self.recv_sock, _ = server.accept()
+        server.close()
+        for sock in (self.send_sock, self.recv_sock):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.world_size > 1:
+            self.send_sock.close()
+            self.recv_sock.close()
+
+    def _recv_into(self, buf):
+        buf = _bytes(buf)
+        while len(buf):
+            n = self.recv_sock.recv_into(buf)
+            if n == 0:
+                raise ConnectionError('ring neighbour %d closed the connection' % ((self.rank-1) % self.world_size))
+            buf = buf[n:]
+
+    def _exchange(self, send, recv):
+        # send to the next worker while receiving from the previous one, so no worker blocks on a full socket buffer
+        sender = threading.Thread(target=self.send_sock.sendall, args=(_bytes(send),))
+        sender.start()
+        self._recv_into(recv)
+        sender.join()
+
+    def allreduce(self, x):
+        """
+        sum the contiguous 1-d array x over all workers in place: a reduce-scatter then an allgather,
+        every worker sends and receives 2*(world_size-1)/world_size of x
+        """
+        w, r = self.world_size, self.rank
+        if w == 1:
+            return x
+        assert x.ndim == 1 and x.flags.c_contiguous
+        bounds = [len(x)*i//w for i in range(w+1)]
+        chunk = lambda i: x[bounds[i]:bounds[i+1]]
+        tmp = np.empty(bounds[-1]//w+1, dtype=x.dtype)
+        for s in range(w-1):
+            recv = chunk((r-s-1) % w)
+            self._exchange(chunk((r-s) % w), tmp[:len(recv)])
+            recv += tmp[:len(recv)]
+        # worker r now holds the complete sum of chunk r+1
+        for s in range(w-1):
+            self._exchange(chunk((r-s+1) % w), chunk((r-s) % w))
+        return x
+
+    def broadcast(self, x, root=0):
+        """
+        overwrite the contiguous array x with its value on root, passed along the ring
+        """
+        if self.world_size == 1:
+            return x
+        if self.rank != root:
+            self._recv_into(x)
+        if (self.rank+1) % self.world_size != root:
+            self.send_sock.sendall(_bytes(x))
+        return x
+
+    def barrier(self):
+        self.allreduce(np.zeros(1, dtype=np.float32))
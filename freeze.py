@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: freeze.py
+
+"""
+frozen inference graph of a trained run: the classifier logits only, variables folded into constants:
+python freeze.py --save_dir save/ --out save/frozen.pb
+the graph takes X [n, 2, n_seq] and L [n, 2] for any n, n_seq is n_ctx unless --n_seq is given. with the
+sequence length static the causal masks and position ids are computed once at export time. the input and
+output names are written next to it as <out>.json, FrozenModel loads both (see serve.py --frozen)
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+def fold_constants(graph_def, input_names, output_names):
+    """
+    graph_def with every tensor that does not depend on the inputs (causal masks, position ids and embeddings)
+    evaluated once and replaced by a constant, equal values sharing one node, then pruned to the outputs
+    """
+    import tensorflow as tf
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    # imported ops come in execution order, an op is dynamic if it reads an input or has state
+    dynamic = set(input_names)
+    for op in graph.get_operations():
+        if op.op_def.is_stateful or any(t.op.name in dynamic for t in op.inputs) or \
+                any(c.name in dynamic for c in op.control_inputs):
+            dynamic.add(op.name)
+    fold = {}
+    for op in graph.get_operations():
+        if op.name in dynamic or op.name in output_names:
+            tensors = op.inputs if op.name in dynamic else op.outputs
+            for t in tensors:
+                if t.op.name not in dynamic and t.op.type != 'Const' and t.dtype not in (tf.resource, tf.variant):
+                    fold[t.name] = t
+    names = sorted(fold)
+    with tf.Session(graph=graph) as sess:
+        values = sess.run([fold[name] for name in names])
+    folded = tf.Graph()
+    with folded.as_default():
+        consts, input_map = {}, {}
+        for name, value in zip(names, values):
+            key = (value.dtype.str, value.shape, value.tobytes())
+            if key not in consts:
+                consts[key] = tf.constant(value, name='folded/%d' % len(consts))
+            input_map[name] = consts[key]
+        tf.import_graph_def(graph_def, input_map=input_map, name='')
+    return tf.graph_util.extract_sub_graph(folded.as_graph_def(), output_names)
+
+
+def freeze(sess, inputs, outputs):
+    """
+    GraphDef computing the outputs tensors from the inputs placeholders of sess.graph, with the variable values of
+    sess as constants and everything else (losses, LM head, optimizer, savers) pruned
+    """
+    import tensorflow as tf
+    input_names = [t.op.name for t in inputs]
+    output_names = [t.op.name for t in outputs]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    for node in graph_def.node:
+        node.device = ''
+    return fold_constants(graph_def, input_names, output_names)
+
+
+def write_frozen(graph_def, path, inputs, outputs, **meta):
+    # the graph and a json of the tensor names FrozenModel feeds and fetches
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    meta.update(inputs=[t.name for t in inputs], outputs=[t.name for t in outputs])
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+class FrozenModel(object):
+    """
+    the clf_logits of a graph written by write_frozen, the interface of inference.NumpyModel
+    """
+
+    def __init__(self, path):
+        import tensorflow as tf
+        with open(path + '.json') as f:
+            self.meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.X, self.L = [self.graph.get_tensor_by_name(name) for name in self.meta['inputs']]
+        self.clf_logits = self.graph.get_tensor_by_name(self.meta['outputs'][0])
+        self.sess = tf.Session(graph=self.graph)
+        # positions available to a sequence
+        self.n_ctx = self.meta['n_seq']
+
+    def logits(self, xmb, lmb):
+        # xmb is padded or cut to the n_seq of the graph
+        xmb = np.asarray(xmb)
+        n_seq = xmb.shape[2]
+        assert np.max(lmb) <= self.n_ctx, 'sequences longer than the %d positions of the frozen graph' % self.n_ctx
+        if n_seq < self.n_ctx:
+            xmb = np.pad(xmb, [(0, 0), (0, 0), (0, self.n_ctx-n_seq)], 'constant')
+        X = xmb[:, :, :self.n_ctx].astype(self.X.dtype.as_numpy_dtype)
+        return self.sess.run(self.clf_logits, {self.X:X, self.L:lmb})
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_dir', type=str, default='save/')
+    parser.add_argument('--checkpoint', type=str, default='')
+    parser.add_argument('--out', type=str, default='')
+    parser.add_argument('--n_seq', type=int, default=None)
+    return parser
+
+
+def main(args):
+    from predict import load_run
+    timing = {}
+    # one tower and the dense attention, whose mask folds into a constant for a static n_seq
+    train, manifest = load_run(args.save_dir, args.checkpoint, timing=timing, n_batch=0, n_seq=args.n_seq,
+                               n_gpu=1, bucket_size=0, attn_impl='dense', shared_prefix=False)
+    inputs, outputs = [train.X_train, train.L_train], [train.eval_mgpu_logits]
+    t = time.time()
+    graph_def = freeze(train.sess, inputs, outputs)
+    timing['freeze_s'] = time.time()-t
+    out = args.out or os.path.join(args.save_dir, 'frozen.pb')
+    write_frozen(graph_def, out, inputs, outputs, n_seq=train.X_train.shape.as_list()[2], n_vocab=manifest['n_vocab'],
+                 n_special=manifest['n_special'], checkpoint=timing['checkpoint'])
+    n_nodes = len(train.sess.graph.as_graph_def().node)
+    print("Froze %s to %s: %d of %d nodes, %.1f MB" % (timing['checkpoint'], out, len(graph_def.node), n_nodes,
+                                                        os.path.getsize(out)/2.**20))
+    print(' , '.join('%s: %.2f' % (k, v) for k, v in timing.items() if k.endswith('_s')))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: inference.py
+
+"""
+the classifier forward pass of train.model in numpy, for scoring without tensorflow:
+python inference.py export --checkpoint save/rocstories-best-1000 --out save/weights.npz
+converts a train.py checkpoint once (this step needs tensorflow), NumpyModel then loads the .npz
+python inference.py quantize --weights save/weights.npz --out save/weights_int8.npz
+stores the conv1d matrices and we as int8 with per-channel scales, NumpyModel loads either file
+"""
+
+import math
+import argparse
+import numpy as np
+
+
+def load_weights(path):
+    """
+    {name: array} of the model variables of a train.py checkpoint, names as in restore_v ('model/we:0', ...),
+    a .npz written by export_weights loads without tensorflow
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return {name:f[name] for name in f.files}
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(path)
+    # the checkpoint also holds the optimizer state, only the model variables are needed
+    return {name:reader.get_tensor(name) for name in reader.get_variable_to_shape_map() if name.startswith('model/')}
+
+
+def export_weights(path, out_path):
+    weights = load_weights(path)
+    np.savez(out_path, **weights)
+    return out_path
+
+
+def quantize(w, axis):
+    """
+    symmetric int8 quantization of w with one float32 scale per index of axis: w ~= q*scale
+    """
+    reduce_axes = tuple(i for i in range(w.ndim) if i != axis % w.ndim)
+    scale = np.abs(w).max(axis=reduce_axes, keepdims=True)/127.
+    scale = np.where(scale > 0, scale, 1.).astype(np.float32)
+    q = np.clip(np.round(w/scale), -127, 127).astype(np.int8)
+    return q, scale.reshape(-1)
+
+
+def quantize_weights(weights):
+    """
+    int8 copies of the conv1d weights (c_attn, c_proj, c_fc), scaled per output channel, and of we, scaled per row,
+    as '<name>' int8 plus '<name>.scale' entries, the other variables are kept as they are
+    """
+    out = {}
+    for name, value in weights.items():
+        if name == 'model/we:0' or (name.endswith('/w:0') and value.ndim == 3):
+            out[name], out[name + '.scale'] = quantize(value, 0 if name == 'model/we:0' else -1)
+        else:
+            out[name] = value
+    return out
+
+
+class Int8Matrix(object):
+    """
+    a [nx, nf] weight matrix stored as int8 with scales per output column (axis=1) or per row (axis=0, embeddings)
+    """
+
+    def __init__(self, q, scale, axis=1):
+        self.q = q.reshape(-1, q.shape[-1])
+        self.scale = scale
+        self.axis = axis
+        self.shape = self.q.shape
+        self.nbytes = self.q.nbytes+scale.nbytes
+
+    def __len__(self):
+        return len(self.q)
+
+    def rdot(self, x, block=1 << 20):
+        # x.dot(w), numpy has no int8 matmul: w is converted to float32 a block of at most block elements at a
+        # time and the column scales apply to the result. the float32 copy is transient and small, what shrinks is
+        # the memory the weights hold, every call still reads and converts all of q (more work than float32 weights)
+        n = max(block//len(self.q), 1)
+        out = np.empty(x.shape[:-1]+(self.q.shape[1],), dtype=np.float32)
+        for i in range(0, self.q.shape[1], n):
+            out[..., i:i+n] = x.dot(self.q[:, i:i+n].astype(np.float32))*self.scale[i:i+n]
+        return out
+
+    def __getitem__(self, idx):
+        # rows of w, dequantized
+        return self.q[idx].astype(np.float32)*self.scale[idx][..., None]
+
+
+def _dot(x, w):
+    return w.rdot(x) if isinstance(w, Int8Matrix) else x.dot(w)
+
+
+def gelu(x):
+    return 0.5*x*(1+np.tanh(math.sqrt(2/math.pi)*(x+0.044715*np.power(x, 3))))
+
+def swish(x):
+    return x/(1+np.exp(-x))
+
+def relu(x):
+    return np.maximum(x, 0)
+
+act_fns = {
+    'relu':relu,
+    'swish':swish,
+    'gelu':gelu
+}
+
+
+def _norm(x, g, b, e=1e-5):
+    u = x.mean(-1, keepdims=True)
+    s = np.square(x-u).mean(-1, keepdims=True)
+    return (x-u)/np.sqrt(s+e)*g + b
+
+
+def _softmax(w):
+    w = np.exp(w-w.max(-1, keepdims=True))
+    return w/w.sum(-1, keepdims=True)
+
+
+class NumpyModel(object):
+    """
+    train.model(X, L, train=False, lm=False) in numpy: the clf_logits of [n, 2, n_seq] token ids and [n, 2] lengths
+    weights: {name: array} as returned by load_weights
+    """
+
+    def __init__(self, weights, n_head, n_vocab, n_special=3, afn='gelu'):
+        w = {name[len('model/'):].replace(':0', ''):np.ascontiguousarray(value) if value.dtype == np.int8 else
+             np.ascontiguousarray(value, dtype=np.float32) for name, value in weights.items() if name.startswith('model/')}
+        # int8 matrices written by quantize_weights
+        for name in [name for name in w if name.endswith('.scale')]:
+            base = name[:-len('.scale')]
+            w[base] = Int8Matrix(w[base], w.pop(name), axis=0 if base == 'we' else 1)
+        self.n_head = n_head
+        self.n_vocab = n_vocab
+        self.n_special = n_special
+        self.act = act_fns[afn]
+        self.we = w['we']
+        self.n_ctx = len(self.we)-n_vocab-n_special
+        self.n_layer = len([name for name in w if name.endswith('/attn/c_attn/w')])
+        # conv1d weights are [1, nx, nf], kept as [nx, nf] matrices
+        self.layers = []
+        for i in range(self.n_layer):
+            prefix = 'h%d/' % i
+            p = {name[len(prefix):]:value for name, value in w.items() if name.startswith(prefix)}
+            self.layers.append({name:value.reshape(-1, value.shape[-1]) if name.endswith('/w') and not isinstance(value, Int8Matrix)
+                                else value for name, value in p.items()})
+        self.clf_w = w['clf/w']
+        self.clf_b = w['clf/b']
+        self.causal = np.tril(np.ones([self.n_ctx, self.n_ctx], dtype=bool))
+
+    @classmethod
+    def from_checkpoint(cls, path, **kwargs):
+        return cls(load_weights(path), **kwargs)
+
+    @property
+    def nbytes(self):
+        # bytes of weights held
+        arrays = [self.we, self.clf_w, self.clf_b]+[value for p in self.layers for value in p.values()]
+        return sum(a.nbytes for a in arrays)
+
+    def attn(self, x, p):
+        n, t, d = x.shape
+        h = self.n_head
+        c = _dot(x.reshape(-1, d), p['attn/c_attn/w'])+p['attn/c_attn/b']
+        q, k, v = [a.reshape(n, t, h, d//h).transpose(0, 2, 1, 3) for a in np.split(c, 3, 1)]
+        w = np.matmul(q, k.transpose(0, 1, 3, 2))/math.sqrt(d//h)
+        w = _softmax(np.where(self.causal[:t, :t], w, -1e9))
+        a = np.matmul(w, v).transpose(0, 2, 1, 3).reshape(-1, d)
+        return (_dot(a, p['attn/c_proj/w'])+p['attn/c_proj/b']).reshape(n, t, d)
+
+    def mlp(self, x, p):
+        n, t, d = x.shape
+        h = self.act(_dot(x.reshape(-1, d), p['mlp/c_fc/w'])+p['mlp/c_fc/b'])
+        return (_dot(h, p['mlp/c_proj/w'])+p['mlp/c_proj/b']).reshape(n, t, d)
+
+    def block(self, x, p):
+        n = _norm(x+self.attn(x, p), p['ln_1/g'], p['ln_1/b'])
+        return _norm(n+self.mlp(n, p), p['ln_2/g'], p['ln_2/b'])
+
+    def logits(self, xmb, lmb):
+        L = np.asarray(lmb).reshape(-1)
+        # under the causal mask nothing right of the longest sequence reaches the classify tokens
+        n_seq = int(L.max())
+        X = np.asarray(xmb).reshape(len(L), -1)[:, :n_seq].astype(np.int64)
+        pos = self.n_vocab+self.n_special
+        h = self.we[X]+self.we[np.arange(pos, pos+n_seq)]
+        for p in self.layers:
+            h = self.block(h, p)
+        h = h[np.arange(len(L)), L-1]
+        return (h.dot(self.clf_w)+self.clf_b).reshape(-1, 2)
+
+
+class Scorer(object):
+    """
+    (question, answer1, answer2) triples to the logits of NumpyModel, the texts encoded and laid out as transform_roc does
+    max_len: the max_len of the training run (manifest.json), texts are cut to it as in training and further so that
+    both candidates fit the n_ctx positions of the model, as GraphScorer does
+    """
+
+    def __init__(self, model, text_encoder, max_len):
+        self.model = model
+        self.text_encoder = text_encoder
+        n_vocab = len(text_encoder.encoder)
+        self.start, self.delimiter, self.clf_token = n_vocab, n_vocab+1, n_vocab+2
+        self.max_len = max_len
+
+    def transform(self, questions, answers1, answers2):
+        X1, X2, X3 = [self.text_encoder.encode_ragged(texts, verbose=False) for texts in (questions, answers1, answers2)]
+        n = len(X1)
+        lmb = np.zeros((n, 2), dtype=np.int32)
+        rows = []
+        n_ctx = self.model.n_ctx
+        for i in range(n):
+            x1 = X1[i][:min(self.max_len, n_ctx-3)]
+            for j, xj in enumerate((X2[i], X3[i])):
+                x = [self.start]+list(x1)+[self.delimiter]+list(xj[:min(self.max_len, n_ctx-3-len(x1))])+[self.clf_token]
+                rows.append(x)
+                lmb[i, j] = len(x)
+        xmb = np.zeros((n, 2, lmb.max() if n else 1), dtype=np.int32)
+        for k, x in enumerate(rows):
+            xmb[k//2, k%2, :len(x)] = x
+        return xmb, lmb
+
+    def score(self, questions, answers1, answers2, n_batch=32):
+        """
+        [n, 2] logits, batched over the examples sorted by length
+        """
+        xmb, lmb = self.transform(questions, answers1, answers2)
+        logits = np.zeros((len(lmb), 2), dtype=np.float32)
+        order = np.argsort(lmb.max(1), kind='stable')
+        for i in range(0, len(order), n_batch):
+            idx = order[i:i+n_batch]
+            logits[idx] = self.model.logits(xmb[idx], lmb[idx])
+        return logits
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('export')
+    p.add_argument('--checkpoint', type=str, required=True)
+    p.add_argument('--out', type=str, required=True)
+    p = sub.add_parser('quantize')
+    p.add_argument('--weights', type=str, required=True)
+    p.add_argument('--out', type=str, required=True)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    if args.command == 'export':
+        print("Exported %s to %s" % (args.checkpoint, export_weights(args.checkpoint, args.out)))
+    elif args.command == 'quantize':
+        np.savez(args.out, **quantize_weights(load_weights(args.weights)))
+        print("Quantized %s to %s" % (args.weights, args.out))
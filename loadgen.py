@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: loadgen.py
+
+"""
+load generator for serve.py: n_clients threads send /score requests back to back for duration seconds, then
+the client side latency percentiles and throughput are printed next to the /metrics of the server, ex.
+python loadgen.py --url http://127.0.0.1:8080 --n_clients 1 8 32 --data baike_qa2019/baike_qa_test.json
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+import numpy as np
+from urllib.request import Request, urlopen
+
+
+def load_requests(path, n=1000, seed=0):
+    # (question, answer_a, answer_b) from a baike qa jsonl file, or random texts without one
+    rng = random.Random(seed)
+    if path:
+        pairs = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                data = json.loads(line)
+                pairs.append((data['desc'] or data['title'], data['answer']))
+                if len(pairs) >= n:
+                    break
+        return [(q, a, pairs[rng.randrange(len(pairs))][1]) for q, a in pairs]
+    chars = [chr(c) for c in range(0x4e00, 0x4e00+500)]
+    text = lambda: ''.join(rng.choice(chars) for _ in range(rng.randint(5, 60)))
+    return [(text(), text(), text()) for _ in range(n)]
+
+
+def post(url, body):
+    request = Request(url, data=json.dumps(body).encode('utf-8'), headers={'Content-Type':'application/json'})
+    with urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def run(url, requests, n_clients, duration):
+    latencies, batch_sizes, errors = [], [], [0]
+    lock = threading.Lock()
+    stop = time.time()+duration
+
+    def client(k):
+        i = k
+        while time.time() < stop:
+            q, a, b = requests[i % len(requests)]
+            i += n_clients
+            t = time.time()
+            try:
+                r = post(url + '/score', {'question':q, 'answer_a':a, 'answer_b':b})
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time()-t)
+                batch_sizes.append(r['batch_size'])
+
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(n_clients)]
+    t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time()-t
+    latencies = np.asarray(latencies)*1000.
+    r = dict(n_clients=n_clients, n_requests=len(latencies), n_errors=errors[0], requests_per_s=len(latencies)/elapsed)
+    if len(latencies):
+        r.update({'p%d_ms' % p:float(np.percentile(latencies, p)) for p in [50, 90, 99]})
+        r['mean_batch_size'] = float(np.mean(batch_sizes))
+    return r
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080')
+    parser.add_argument('--n_clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--data', type=str, default='')
+    parser.add_argument('--n_requests', type=int, default=1000)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    requests = load_requests(args.data, args.n_requests)
+    print('%8s %10s %8s %10s %10s %10s %10s' % ('clients', 'req/s', 'errors', 'p50_ms', 'p90_ms', 'p99_ms', 'batch'))
+    for n_clients in args.n_clients:
+        r = run(args.url, requests, n_clients, args.duration)
+        print('%8d %10.1f %8d %10.2f %10.2f %10.2f %10.2f' % (n_clients, r['requests_per_s'], r['n_errors'], r.get('p50_ms', 0),
+                                                              r.get('p90_ms', 0), r.get('p99_ms', 0), r.get('mean_batch_size', 0)))
+    with urlopen(args.url + '/metrics') as response:
+        print('server metrics: %s' % response.read().decode('utf-8'))
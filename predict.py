@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: predict.py
+
+"""
+test set predictions of a trained run, without the training setup:
+python predict.py --save_dir save/
+reads save_dir/manifest.json written by train.py, parses and encodes only the test file, builds only the
+inference graph and restores the model variables of the latest (or --checkpoint) checkpoint. the time of
+every stage is printed and appended to save_dir/predict_timing.jsonl
+"""
+
+import time
+start_time = time.time()
+import os
+import json
+import argparse
+import numpy as np
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_dir', type=str, default='save/')
+    parser.add_argument('--checkpoint', type=str, default='')
+    parser.add_argument('--data_dir', type=str, default=None)
+    parser.add_argument('--encoder_path', type=str, default=None)
+    parser.add_argument('--submission_dir', type=str, default=None)
+    parser.add_argument('--n_proc', type=int, default=None)
+    parser.add_argument('--n_gpu', type=int, default=None)
+    return parser
+
+
+def load_run(save_dir, checkpoint='', timing=None, n_batch=None, n_seq=None, **overrides):
+    """
+    train.py configured as in the run of save_dir (overrides that are not None replace its arguments), with the
+    logits graph of mgpu_predict built and the checkpoint restored into train.sess, returns (train, manifest)
+    n_batch, n_seq: static sizes of the X_train placeholder, n_batch_train and n_ctx (unknown with --bucket_size)
+    by default, n_batch=0 leaves the batch size unknown
+    """
+    timing = {} if timing is None else timing
+    t = time.time()
+    with open(os.path.join(save_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    config = manifest['args']
+    config.update({k:v for k, v in overrides.items() if v is not None})
+
+    import tensorflow as tf
+    import train
+    timing['import_s'] = time.time()-t
+
+    # the module globals the graph and batching code of train.py read, as they were in the training run
+    for k, v in config.items():
+        setattr(train, k, v)
+    train.n_ctx = manifest['n_ctx']
+    train.n_vocab = manifest['n_vocab']
+    train.n_special = manifest['n_special']
+    train.max_len = manifest['max_len']
+    train.token_dtype = np.dtype(manifest['token_dtype']).type
+    train.encoder = manifest['special_tokens']
+    train.clf_token = train.encoder['_classify_']
+    train.lm_cutoffs = []
+    train.dataset = config.get('dataset') or 'rocstories'
+    train.n_batch_train = config['n_batch']*config['n_gpu']
+    train.batch_transform = None
+
+    t = time.time()
+    n_batch = train.n_batch_train if n_batch is None else n_batch or None
+    n_seq = n_seq or (None if config['bucket_size'] > 0 else train.n_ctx)
+    train.X_train = tf.placeholder(tf.as_dtype(train.token_dtype), [n_batch, 2, n_seq])
+    train.L_train = tf.placeholder(tf.int32, [n_batch, 2])
+    # logits only: no LM head, no losses, no optimizer
+    train.eval_mgpu_logits = train.mgpu_predict(train.X_train, train.L_train, lm=False, reuse=False)[0]
+    train.sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+    timing['graph_s'] = time.time()-t
+
+    t = time.time()
+    checkpoint = checkpoint or tf.train.get_checkpoint_state(save_dir).model_checkpoint_path
+    tf.train.Saver({v.name:v for v in tf.global_variables()}).restore(train.sess, checkpoint)
+    timing['restore_s'] = time.time()-t
+    timing['checkpoint'] = checkpoint
+    return train, manifest
+
+
+class GraphScorer(object):
+    """
+    (question, answer1, answer2) triples to logits with the restored graph of load_run, the interface of inference.Scorer
+    """
+
+    def __init__(self, train, text_encoder):
+        self.train = train
+        self.text_encoder = text_encoder
+
+    def transform(self, questions, answers1, answers2):
+        # one token per character: the texts are cut as transform_roc cuts the tokens, and further so that
+        # both candidates fit the n_ctx positions of the model
+        max_len, n_ctx = self.train.max_len, self.train.n_ctx
+        questions = [q[:min(max_len, n_ctx-3)] for q in questions]
+        answers1 = [a[:min(max_len, n_ctx-3-len(q))] for q, a in zip(questions, answers1)]
+        answers2 = [a[:min(max_len, n_ctx-3-len(q))] for q, a in zip(questions, answers2)]
+        X1, X2, X3 = [self.text_encoder.encode_ragged(texts, verbose=False) for texts in (questions, answers1, answers2)]
+        return self.train.transform_roc(X1, X2, X3)
+
+    def score(self, questions, answers1, answers2):
+        train = self.train
+        xmb, lmb = self.transform(questions, answers1, answers2)
+        if train.bucket_size > 0:
+            xmb, lmb = train.trim_roc(xmb, lmb)
+        logits = []
+        for i in range(0, len(xmb), train.n_batch_train):
+            n = len(xmb[i:i+train.n_batch_train])
+            x, l = train.pad_batch(n, xmb[i:i+train.n_batch_train], lmb[i:i+train.n_batch_train])
+            logits.append(train.sess.run(train.eval_mgpu_logits, {train.X_train:x, train.L_train:l})[:n])
+        return np.concatenate(logits, 0) if logits else np.zeros((0, 2), dtype=np.float32)
+
+
+def main(args):
+    timing = {}
+    train, manifest = load_run(args.save_dir, args.checkpoint, timing=timing, data_dir=args.data_dir,
+                               encoder_path=args.encoder_path, submission_dir=args.submission_dir, n_gpu=args.n_gpu)
+    from datasets import test_data_process
+    from text_utils import TextEncoder
+    from utils import encode_dataset
+
+    t = time.time()
+    text_encoder = TextEncoder(train.encoder_path)
+    te = test_data_process(train.data_dir, manifest['n_train'], seed=train.seed, n_proc=args.n_proc)
+    (teX1, teX2, teX3), = encode_dataset([te], encoder=text_encoder)
+    if train.lazy_transform:
+        train.te_data = (teX1, teX2, teX3)
+        train.te_lengths = train.roc_lengths(teX1, teX2, teX3)+3
+        train.batch_transform = train.lazy_roc
+    else:
+        teX, teL = train.transform_roc(teX1, teX2, teX3)
+        train.te_data = (teX, teL)
+        train.te_lengths = teL.max(1)
+        train.batch_transform = train.trim_roc if train.bucket_size > 0 else None
+    timing['data_s'] = time.time()-t
+
+    t = time.time()
+    train.predict()
+    timing['predict_s'] = time.time()-t
+    timing['total_s'] = time.time()-start_time
+    timing.update(n_test=len(teX1), time=time.time())
+    print(' , '.join('%s: %.2f' % (k, v) for k, v in timing.items() if k.endswith('_s')))
+    with open(os.path.join(args.save_dir, 'predict_timing.jsonl'), 'a') as f:
+        f.write(json.dumps(timing)+'\n')
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: serve.py
+
+"""
+local scoring server keeping a trained model resident, concurrent requests are coalesced into micro-batches:
+python serve.py --save_dir save/ --port 8080                       # the tensorflow graph of the run
+python serve.py --save_dir save/ --weights save/weights.npz       # the numpy engine of inference.py
+python serve.py --save_dir save/ --frozen save/frozen.pb          # the frozen graph of freeze.py
+POST /score {"question": ..., "answer_a": ..., "answer_b": ...} -> {"logits": [a, b], "prediction": 0 or 1, ...}
+GET /metrics -> latency percentiles and batch fill, see loadgen.py for a load generator
+"""
+
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import numpy as np
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class MicroBatcher(object):
+    """
+    runs fn over batches of the items submitted from many threads: a batch is closed once it holds max_batch
+    items or max_wait seconds after its first item arrived, fn(items) returns one result per item
+    """
+
+    def __init__(self, fn, max_batch=32, max_wait=0.005, n_window=10000):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # the last n_window requests and batches
+        self.latencies = collections.deque(maxlen=n_window)
+        self.queue_waits = collections.deque(maxlen=n_window)
+        self.batch_sizes = collections.deque(maxlen=n_window)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        # blocks until the batch holding item ran, returns (result, size of that batch)
+        request = {'item':item, 'time':time.time(), 'done':threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result'], request['batch_size']
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time()+self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline-time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                # e.g. fn returned fewer results than items, the requests still waiting get the error
+                failed = [r for r in batch if 'result' not in r and 'error' not in r]
+                for r in failed:
+                    r['error'] = e
+                with self.lock:
+                    self.n_requests += len(failed)
+                    self.n_errors += len(failed)
+            finally:
+                # every submit() returns, whatever happened to its batch
+                for r in batch:
+                    r['done'].set()
+
+    def _call(self, items):
+        # (results, errors) of fn over items, a failed batch is scored again item by item so that one bad item
+        # only fails its own request
+        try:
+            return self.fn(items), [None]*len(items)
+        except Exception as e:
+            if len(items) == 1:
+                return [None], [e]
+        results, errors = [], []
+        for item in items:
+            try:
+                results.append(self.fn([item])[0])
+                errors.append(None)
+            except Exception as e:
+                results.append(None)
+                errors.append(e)
+        return results, errors
+
+    def _run_batch(self, batch):
+        start = time.time()
+        results, errors = self._call([r['item'] for r in batch])
+        end = time.time()
+        with self.lock:
+            self.batch_sizes.append(len(batch))
+            for i, r in enumerate(batch):
+                if errors[i] is not None:
+                    r['error'] = errors[i]
+                    self.n_errors += 1
+                else:
+                    r['result'] = results[i]
+                r['batch_size'] = len(batch)
+                self.n_requests += 1
+                self.queue_waits.append(start-r['time'])
+                self.latencies.append(end-r['time'])
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies)*1000.
+            queue_waits = np.asarray(self.queue_waits)*1000.
+            batch_sizes = np.asarray(self.batch_sizes)
+            m = dict(n_requests=self.n_requests, n_errors=self.n_errors, n_batches=len(batch_sizes),
+                     max_batch=self.max_batch, max_wait_ms=self.max_wait*1000.)
+        if len(latencies):
+            for p in [50, 90, 99]:
+                m['latency_p%d_ms' % p] = float(np.percentile(latencies, p))
+            m['queue_wait_p50_ms'] = float(np.percentile(queue_waits, 50))
+        if len(batch_sizes):
+            m['mean_batch_size'] = float(batch_sizes.mean())
+            # how full the batches were relative to max_batch
+            m['batch_fill'] = float(batch_sizes.mean()/self.max_batch)
+            m['batch_size_hist'] = {int(k):int(v) for k, v in zip(*np.unique(batch_sizes, return_counts=True))}
+        return m
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the default listen backlog of 5 refuses connections under a few dozen concurrent clients
+    request_queue_size = 128
+
+
+def make_handler(batcher):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, batcher.metrics())
+            elif self.path == '/health':
+                self._reply(200, {'ok':True})
+            else:
+                self._reply(404, {'error':'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self._reply(404, {'error':'not found'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                item = (request['question'], request['answer_a'], request['answer_b'])
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, {'error':'bad request: %r' % e})
+            if not all(isinstance(field, str) for field in item):
+                return self._reply(400, {'error':'bad request: question, answer_a and answer_b must be strings'})
+            try:
+                logits, batch_size = batcher.submit(item)
+            except Exception as e:
+                return self._reply(500, {'error':repr(e)})
+            self._reply(200, {'logits':[float(x) for x in logits], 'prediction':int(np.argmax(logits)), 'batch_size':batch_size})
+
+        def log_message(self, format, *args):
+            # no line per request
+            pass
+
+    return Handler
+
+
+def load_scorer(args):
+    # an object with score(questions, answers1, answers2) -> [n, 2] logits
+    from text_utils import TextEncoder
+    with open(os.path.join(args.save_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    config = manifest['args']
+    text_encoder = TextEncoder(args.encoder_path or config['encoder_path'])
+    if args.frozen:
+        from freeze import FrozenModel
+        from inference import Scorer
+        return Scorer(FrozenModel(args.frozen), text_encoder, manifest['max_len'])
+    if args.weights:
+        from inference import NumpyModel, Scorer
+        model = NumpyModel.from_checkpoint(args.weights, n_head=config['n_head'], n_vocab=manifest['n_vocab'],
+                                           n_special=manifest['n_special'], afn=config['afn'])
+        return Scorer(model, text_encoder, manifest['max_len'])
+    from predict import load_run, GraphScorer
+    train, _ = load_run(args.save_dir, args.checkpoint, encoder_path=args.encoder_path)
+    return GraphScorer(train, text_encoder)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_dir', type=str, default='save/')
+    parser.add_argument('--checkpoint', type=str, default='')
+    parser.add_argument('--weights', type=str, default='')
+    parser.add_argument('--frozen', type=str, default='')
+    parser.add_argument('--encoder_path', type=str, default=None)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_batch', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=5.)
+    return parser
+
+
+def serve(scorer, host='127.0.0.1', port=8080, max_batch=32, max_wait_ms=5.):
+    score = lambda items: scorer.score(*[list(field) for field in zip(*items)])
+    batcher = MicroBatcher(score, max_batch=max_batch, max_wait=max_wait_ms/1000.)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print("Serving on http://%s:%d" % (host, port))
+    return server
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    server = serve(load_scorer(args), args.host, args.port, args.max_batch, args.max_wait_ms)
+    server.serve_forever()
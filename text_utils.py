@@ -5,9 +5,70 @@
 # Date: 19-2-22
 
 import json
+import numpy as np
 from tqdm import tqdm
 
 
+class RaggedTokens(object):
+    """
+    a list of token sequences stored as one flat int32 token buffer plus an offsets array,
+    sequence i is tokens[offsets[i]:offsets[i+1]]
+    """
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            return self.tokens[self.offsets[idx]:self.offsets[idx+1]]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                offsets = self.offsets[start:max(start, stop)+1]
+                return RaggedTokens(self.tokens[offsets[0]:offsets[-1]], offsets-offsets[0])
+            idx = np.arange(start, stop, step)
+        return self.take(idx)
+
+    def prefix_index(self, limit):
+        """
+        scatter coordinates of the first min(len, limit) tokens of every sequence:
+        (rows, cols, values) with values[k] = self[rows[k]][cols[k]]
+        """
+        lengths = np.minimum(self.lengths, limit)
+        starts = np.zeros(len(self)+1, dtype=np.int64)
+        np.cumsum(lengths, out=starts[1:])
+        rows = np.repeat(np.arange(len(self)), lengths)
+        cols = np.arange(starts[-1])-np.repeat(starts[:-1], lengths)
+        values = self.tokens[self.offsets[:-1][rows]+cols]
+        return rows, cols, values
+
+    def take(self, idx):
+        """
+        gather the sequences at positions idx into a new RaggedTokens
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        starts = self.offsets[idx]
+        lengths = self.offsets[idx+1]-starts
+        offsets = np.zeros(len(idx)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        src = np.repeat(starts-offsets[:-1], lengths)+np.arange(offsets[-1])
+        return RaggedTokens(self.tokens[src], offsets)
+
+
 class TextEncoder(object):
     """
     mostly a wrapper for a public python bpe tokenizer
@@ -16,6 +77,11 @@ class TextEncoder(object):
     def __init__(self, encoder_path):
         self.encoder = json.load(open(encoder_path))
         self.decoder = {v:k for k,v in self.encoder.items()}
+        # codepoint -> id, the extra last slot maps every codepoint past the table to 0
+        chars = [(ord(k), v) for k, v in self.encoder.items() if len(k) == 1]
+        self.lookup = np.zeros(max([c for c, _ in chars]+[0])+2, dtype=np.int32)
+        for c, v in chars:
+            self.lookup[c] = v
 
     def encode(self, texts, verbose=True):
         # input : trX1: [sentence1, sentence2...]
@@ -35,3 +101,21 @@ class TextEncoder(object):
                 texts_tokens.append(text_tokens)
         return texts_tokens
         # texts_tokens = [[id1_sen1, id2_sen1,...],[id1_sen2, id2_sen2],...]
+
+    def encode_ragged(self, texts, verbose=True, chunk_size=100000):
+        """
+        same ids as encode, mapped through the codepoint lookup table a chunk of texts at a time
+        """
+        n = len(texts)
+        offsets = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(text) for text in texts), dtype=np.int64, count=n), out=offsets[1:])
+        tokens = np.empty(offsets[-1], dtype=np.int32)
+        chunks = range(0, n, chunk_size)
+        if verbose:
+            chunks = tqdm(chunks, ncols=80, leave=False)
+        for i in chunks:
+            j = min(i+chunk_size, n)
+            cps = np.frombuffer(''.join(texts[i:j]).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+            tokens[offsets[i]:offsets[j]] = self.lookup[np.minimum(cps, len(self.lookup)-1)]
+        return RaggedTokens(tokens, offsets)
+        # texts_tokens.tokens = [id1_sen1, id2_sen1, ..., id1_sen2, id2_sen2, ...], texts_tokens.offsets = [0, len_sen1, ...]
@@ -8,21 +8,20 @@ import os
 import time
 import math
 import json
-import joblib
 import random
 import argparse
 import numpy as np
 import tensorflow as tf
 
-from tqdm import tqdm
 from functools import partial
-from sklearn.utils import shuffle
-from sklearn.metrics import accuracy_score
 
-from opt import adam, warmup_cosine, warmup_linear, warmup_constant
+from opt import adam, fused_adam, accumulate, warmup_cosine, warmup_linear, warmup_constant
 from datasets import data_process
+from cache import cache_key, load_arrays, save_arrays
 from text_utils import TextEncoder
-from utils import encode_dataset, flatten, iter_data, find_trainable_variables, convert_gradient_to_tensor, shape_list, ResultLogger, assign_to_gpu, average_grads, make_path
+from dist import Ring
+from checkpoint import CheckpointWriter, load_state
+from utils import encode_dataset, write_manifest, flatten, iter_data, sum_grads, flatten_grads, unflatten_grads, bucket_batches, shuffle_batches, epoch_random_state, Prefetcher, find_trainable_variables, convert_gradient_to_tensor, shape_list, batch_gather, ResultLogger, assign_to_gpu, average_grads, make_path
 
 def gelu(x):
     return 0.5*x*(1+tf.tanh(math.sqrt(2/math.pi)*(x+0.044715*tf.pow(x, 3))))
@@ -32,6 +31,7 @@ def swish(x):
 
 opt_fns = {
     'adam':adam,
+    'fused_adam':fused_adam,
 }
 
 act_fns = {
@@ -40,6 +40,9 @@ act_fns = {
     'gelu':gelu
 }
 
+# (fn, x, y) of every recomputed block segment of the training tower being built, consumed by mgpu_train
+recompute_segments = []
+
 lr_schedules = {
     'warmup_cosine':warmup_cosine,
     'warmup_linear':warmup_linear,
@@ -61,9 +64,21 @@ def norm(x, scope, axis=[-1]):
         b = tf.get_variable("b", [n_state], initializer=tf.constant_initializer(0))
         return _norm(x, g, b, axis=axis)
 
-def dropout(x, pdrop, train):
+# [seed, counter] while a recomputed segment is being built, its dropout masks are then drawn from
+# stateless random ops so that rebuilding the segment for the backward pass draws the same masks
+dropout_seed = None
+
+def dropout(x, pdrop, train, salt=0, noise_shape=None):
+    # salt: varies the stateless seed inside loops, e.g. per attention tile
+    # noise_shape: as for tf.nn.dropout, dimensions of size 1 share their mask, e.g. whole rows are dropped
     if train and pdrop > 0:
-        x = tf.nn.dropout(x, 1-pdrop)
+        if dropout_seed is None:
+            x = tf.nn.dropout(x, 1-pdrop, noise_shape)
+        else:
+            seed = dropout_seed[0]+tf.cast(tf.stack([dropout_seed[1], salt]), tf.int64)
+            dropout_seed[1] += 1
+            keep = tf.contrib.stateless.stateless_random_uniform(noise_shape or shape_list(x), seed) >= pdrop
+            x = x*tf.cast(keep, x.dtype)/(1-pdrop)
     return x
 
 def mask_attn_weights(w):
@@ -73,14 +88,24 @@ def mask_attn_weights(w):
     w = w*b + -1e9*(1-b)
     return w
 
-def _attn(q, k, v, train=False, scale=False):
+def _attn(q, k, v, train=False, scale=False, past=None, mask=None):
+    # past: (k, v) of a shared prefix the queries also attend to
+    # mask: [batch or 1, 1, n_q, n_k] attention mask, causal over the keys when None
+    if past is None and mask is None and attn_impl == 'chunked':
+        return _chunked_attn(q, k, v, train=train, scale=scale, block_size=attn_block)
+    if past is not None:
+        k = tf.concat([past[0], k], 3)
+        v = tf.concat([past[1], v], 2)
     w = tf.matmul(q, k)
 
     if scale:
         n_state = shape_list(v)[-1]
         w = w*tf.rsqrt(tf.cast(n_state, tf.float32))
 
-    w = mask_attn_weights(w)
+    if mask is None:
+        w = mask_attn_weights(w)
+    else:
+        w = w*mask + -1e9*(1-mask)
     w = tf.nn.softmax(w)
 
     w = dropout(w, attn_pdrop, train)
@@ -88,6 +113,52 @@ def _attn(q, k, v, train=False, scale=False):
     a = tf.matmul(w, v)
     return a
 
+def _chunked_attn(q, k, v, train=False, scale=False, block_size=64):
+    # causal attention computed one [block_size, block_size] tile of scores at a time with an online softmax:
+    # a running max m, normaliser l and output acc per query row are rescaled as key blocks come in,
+    # key blocks right of the diagonal are fully masked and never computed.
+    # the memory saving is for the forward pass (evaluation, prediction): for the gradient the while loops keep
+    # the tensors of every tile, training takes more memory and time than the dense path (benchmark.py attn)
+    # q: [batch, head, n, d], k: [batch, head, d, n], v: [batch, head, n, d]
+    n = shape_list(q)[2]
+    n_blocks = (n+block_size-1)//block_size
+    pad = n_blocks*block_size-n
+    q = tf.pad(q, [[0, 0], [0, 0], [0, pad], [0, 0]])
+    k = tf.pad(k, [[0, 0], [0, 0], [0, 0], [0, pad]])
+    v = tf.pad(v, [[0, 0], [0, 0], [0, pad], [0, 0]])
+    if scale:
+        q = q*tf.rsqrt(tf.cast(shape_list(v)[-1], tf.float32))
+    pos = tf.range(block_size)
+
+    def query_block(i, out):
+        qi = q[:, :, i*block_size:(i+1)*block_size]
+        row_shape = shape_list(qi)[:-1]+[1]
+
+        def key_block(j, m, l, acc):
+            s = tf.matmul(qi, k[:, :, :, j*block_size:(j+1)*block_size])
+            b = tf.cast(j*block_size+pos[None, :] <= i*block_size+pos[:, None], tf.float32)
+            s = s*b + -1e9*(1-b)
+            m_new = tf.maximum(m, tf.reduce_max(s, -1, keep_dims=True))
+            p = tf.exp(s-m_new)
+            corr = tf.exp(m-m_new)
+            l = l*corr + tf.reduce_sum(p, -1, keep_dims=True)
+            # dropping unnormalised weights then dividing by l is dropout on the softmax output
+            p = dropout(p, attn_pdrop, train, salt=i*n_blocks+j)
+            acc = acc*corr + tf.matmul(p, v[:, :, j*block_size:(j+1)*block_size])
+            return j+1, m_new, l, acc
+
+        _, _, l, acc = tf.while_loop(lambda j, *_: j <= i, key_block,
+                                     [tf.constant(0), tf.fill(row_shape, -1e30), tf.zeros(row_shape), tf.zeros_like(qi)])
+        return i+1, out.write(i, acc/l)
+
+    _, out = tf.while_loop(lambda i, _: i < n_blocks, query_block,
+                           [tf.constant(0), tf.TensorArray(tf.float32, size=n_blocks)])
+    a = out.stack()
+    # a.size = [n_blocks, batch, head, block_size, d]
+    a_shape = shape_list(a)
+    a = tf.reshape(tf.transpose(a, [1, 2, 0, 3, 4]), [a_shape[1], a_shape[2], n_blocks*block_size, a_shape[4]])
+    return a[:, :, :n]
+
 def split_states(x, n):
     x_shape = shape_list(x)
     m = x_shape[-1]
@@ -119,7 +190,8 @@ def conv1d(x, scope, nf, rf, w_init=tf.random_normal_initializer(stddev=0.02), b
             c = tf.nn.conv1d(x, w, stride=1, padding=pad)+b
         return c
 
-def attn(x, scope, n_state, n_head, train=False, scale=False):
+def attn(x, scope, n_state, n_head, train=False, scale=False, past=None, mask=None):
+    # returns the attention output and present = (k, v) of x for later queries to attend to
     assert n_state%n_head==0
     with tf.variable_scope(scope):
         c = conv1d(x, 'c_attn', n_state*3, 1, train=train)
@@ -127,11 +199,11 @@ def attn(x, scope, n_state, n_head, train=False, scale=False):
         q = split_heads(q, n_head)
         k = split_heads(k, n_head, k=True)
         v = split_heads(v, n_head)
-        a = _attn(q, k, v, train=train, scale=scale)
+        a = _attn(q, k, v, train=train, scale=scale, past=past, mask=mask)
         a = merge_heads(a)
         a = conv1d(a, 'c_proj', n_state, 1, train=train)
         a = dropout(a, resid_pdrop, train)
-        return a
+        return a, (k, v)
 
 def mlp(x, scope, n_state, train=False):
     with tf.variable_scope(scope):
@@ -142,21 +214,71 @@ def mlp(x, scope, n_state, train=False):
         h2 = dropout(h2, resid_pdrop, train)
         return h2
 
-def block(x, scope, train=False, scale=False):
+def block(x, scope, train=False, scale=False, past=None, mask=None):
     with tf.variable_scope(scope):
         nx = shape_list(x)[-1]
-        a = attn(x, 'attn', nx, n_head, train=train, scale=scale)
+        a, present = attn(x, 'attn', nx, n_head, train=train, scale=scale, past=past, mask=mask)
         n = norm(x+a, 'ln_1')
         m = mlp(n, 'mlp', nx*4, train=train)
         h = norm(n+m, 'ln_2')
-        return h
-
-def embed(X, we):
-    we = convert_gradient_to_tensor(we)
-    e = tf.gather(we, X)
-    h = tf.reduce_sum(e, 2)
+        return h, present
+
+def block_segment(h, layers, train=False, seed=None):
+    # consecutive blocks of a recomputed segment, dropout masks are a function of seed only
+    global dropout_seed
+    dropout_seed = [seed, 0]
+    try:
+        for layer in layers:
+            h, _ = block(h, 'h%d'%layer, train=train, scale=True)
+    finally:
+        dropout_seed = None
     return h
 
+def recompute_gradients(loss, params, segments):
+    """
+    gradients of loss with respect to params when the blocks ran as segments (fn, x, y), y = stop_gradient(fn(x)):
+    the activations inside a segment are freed after the forward pass, its blocks are rebuilt from the
+    checkpoint x once the gradient of y is available and backpropagated on their own
+    """
+    grads = tf.gradients(loss, [segments[-1][2]]+params)
+    gy, grads = grads[0], grads[1:]
+    for fn, x, y in reversed(segments):
+        with tf.control_dependencies([gy]):
+            # do not recompute before the backward pass reaches this segment
+            x = tf.identity(x)
+        with tf.variable_scope('model', reuse=True):
+            y = fn(x)
+        # cut at x: what lies below the segment (the embedding for the first one) is backpropagated once, from gy
+        g = tf.gradients(y, [x]+params, grad_ys=gy, stop_gradients=[x])
+        gy = g[0]
+        grads = [sum_grads(a, b) for a, b in zip(grads, g[1:])]
+    # the embedding below the first segment
+    g = tf.gradients(segments[0][1], params, grad_ys=gy)
+    return [sum_grads(a, b) for a, b in zip(grads, g)]
+
+def embed(X, we, offset=None, train=False):
+    # X: [batch, n_seq] token ids, the position embeddings are the n_ctx rows of we after the vocab and special tokens
+    # offset: [batch] position of the first token of each row, 0 when None
+    # with --sparse_embd the lookups stay gathers of the we variable, so its gradient is IndexedSlices of the
+    # rows used, and embedding dropout drops whole gathered rows (token and position embeddings of a position)
+    # instead of elements of the whole matrix
+    if not sparse_embd:
+        we = convert_gradient_to_tensor(we)
+    n_seq = shape_list(X)[1]
+    h = tf.gather(we, X)
+    if offset is None and not sparse_embd:
+        p = we[n_vocab+n_special:n_vocab+n_special+n_seq]
+    elif offset is None:
+        p = tf.gather(we, n_vocab+n_special+tf.range(n_seq))
+    else:
+        # a row padded out to a longer suffix of the batch can run past the n_ctx position rows, those positions
+        # are masked, clamped like the suffix token gather
+        p = tf.gather(we, n_vocab+n_special+tf.minimum(offset[:, None]+tf.range(n_seq)[None, :], n_ctx-1))
+    if sparse_embd:
+        h = dropout(h, embd_pdrop, train, noise_shape=shape_list(h)[:-1]+[1])
+        p = dropout(p, embd_pdrop, train, noise_shape=shape_list(p)[:-1]+[1])
+    return h+p
+
 def clf(x, ny, w_init=tf.random_normal_initializer(stddev=0.02), b_init=tf.constant_initializer(0), train=False):
     # x.size = [n_batch_train/n_gpu * 2, n_embd]
     # ny = 1
@@ -166,36 +288,149 @@ def clf(x, ny, w_init=tf.random_normal_initializer(stddev=0.02), b_init=tf.const
         b = tf.get_variable("b", [ny], initializer=b_init)
         return tf.matmul(x, w)+b
 
-def model(X, M, Y, train=False, reuse=False):
-    # X = tf.placeholder(tf.int32, [n_batch_train/n_gpu, 2, n_ctx, 2])
-    # M = tf.placeholder(tf.float32, [n_batch_train/n_gpu, 2, n_ctx])
+def adaptive_xent(h, labels, we, cutoffs):
+    # adaptive softmax over the tied embedding, vocab ids are already sorted by frequency (vocab.vocab_process):
+    # the head scores ids [0, cutoffs[0]), the special tokens and one slot per tail cluster,
+    # cluster i only scores rows [cutoffs[i], cutoffs[i+1]) of we for the positions whose label falls in it
+    bounds = list(cutoffs)+[n_vocab]
+    n_clusters = len(bounds)-1
+    with tf.variable_scope('adaptive_softmax', reuse=tf.AUTO_REUSE):
+        cw = tf.get_variable("w", [n_embd, n_clusters], initializer=tf.random_normal_initializer(stddev=0.02))
+        cb = tf.get_variable("b", [n_clusters], initializer=tf.constant_initializer(0))
+    head_w = tf.concat([we[:bounds[0]], we[n_vocab:n_vocab+n_special]], 0)
+    head_logits = tf.concat([tf.matmul(h, head_w, transpose_b=True), tf.matmul(h, cw)+cb], 1)
+    # head_logits.size = [n, cutoffs[0]+n_special+n_clusters]
+    head_labels = tf.where(labels >= n_vocab, labels-n_vocab+bounds[0], labels)
+    for i in range(n_clusters):
+        in_cluster = tf.logical_and(labels >= bounds[i], labels < bounds[i+1])
+        head_labels = tf.where(in_cluster, tf.fill(tf.shape(labels), bounds[0]+n_special+i), head_labels)
+    losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=head_logits, labels=head_labels)
+    for i in range(n_clusters):
+        idx = tf.cast(tf.where(tf.logical_and(labels >= bounds[i], labels < bounds[i+1]))[:, 0], tf.int32)
+        tail_logits = tf.matmul(tf.gather(h, idx), we[bounds[i]:bounds[i+1]], transpose_b=True)
+        tail_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=tail_logits, labels=tf.gather(labels, idx)-bounds[i])
+        losses += tf.scatter_nd(idx[:, None], tail_losses, tf.shape(losses))
+    return losses
+
+def lm_xent(h, labels, we):
+    # h: [n, n_embd], labels: [n] -> [n] cross-entropy of the tied LM head
+    if lm_cutoffs:
+        return adaptive_xent(h, labels, we, lm_cutoffs)
+    lm_logits = tf.matmul(h, we, transpose_b=True)
+    return tf.nn.sparse_softmax_cross_entropy_with_logits(logits=lm_logits, labels=labels)
+
+def shared_prefix_forward(X, L, we, train=False, lm=True):
+    # X: [n_batch*2, n_seq], L: [n_batch*2], rows 2i and 2i+1 are the two candidates of example i
+    # both candidates start with the same [start]+x1+[delimiter] prefix, under the causal mask its hidden
+    # states do not depend on the answer, so the prefix runs through the blocks once per example and only
+    # the answer suffixes run per candidate, attending to the prefix keys and values of every layer
+    n_seq = shape_list(X)[1]
+    xp = tf.reshape(X, [-1, 2, n_seq])[:, 0]
+    lp = tf.cast(tf.argmax(tf.cast(tf.equal(xp, encoder['_delimiter_']), tf.float32), 1), tf.int32)+1
+    n_prefix = tf.reduce_max(lp)
+    xp = xp[:, :n_prefix]
+    # xp.size = [n_batch, n_prefix]
+    lp2 = tf.reshape(tf.tile(lp[:, None], [1, 2]), [-1])
+    ls2 = L-lp2
+    n_suffix = tf.reduce_max(ls2)
+    xs = batch_gather(X, tf.minimum(lp2[:, None]+tf.range(n_suffix)[None, :], n_seq-1))
+    ms = tf.sequence_mask(ls2, n_suffix, dtype=tf.float32)
+    # xs.size = [n_batch*2, n_suffix], the suffix of row i starts at position lp2[i]
+
+    pmask = tf.cast(tf.range(n_prefix)[None, :] < lp[:, None], tf.float32)
+    pmask2 = tf.reshape(tf.tile(pmask[:, None], [1, 2, 1]), [-1, 1, 1, n_prefix])*tf.ones([1, 1, n_suffix, 1])
+    smask = tf.matrix_band_part(tf.ones([n_suffix, n_suffix]), -1, 0)[None, None]*tf.ones([shape_list(xs)[0], 1, 1, 1])
+    mask = tf.concat([pmask2, smask], 3)
+    # mask.size = [n_batch*2, 1, n_suffix, n_prefix+n_suffix]
+
+    hp = embed(xp, we, train=train)
+    hs = embed(xs, we, offset=lp2, train=train)
+    for layer in range(n_layer):
+        hp, (pk, pv) = block(hp, 'h%d'%layer, train=train, scale=True)
+        pk = tf.reshape(tf.tile(pk[:, None], [1, 2, 1, 1, 1]), [-1]+shape_list(pk)[1:])
+        pv = tf.reshape(tf.tile(pv[:, None], [1, 2, 1, 1, 1]), [-1]+shape_list(pv)[1:])
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            hs, _ = block(hs, 'h%d'%layer, train=train, scale=True, past=(pk, pv), mask=mask)
+
+    if lm:
+        lm_losses = shared_prefix_lm_losses(hp, hs, xp, xs, lp, pmask, ms, we)
+    else:
+        lm_losses = None
+
+    # the classify token is the last one of every sequence
+    clf_h = tf.reshape(batch_gather(hs, ls2[:, None]-1), [-1, n_embd])
+    # clf_h.size = [n_batch*2, n_embd]
+    return clf_h, lm_losses
+
+def shared_prefix_lm_losses(hp, hs, xp, xs, lp, pmask, ms, we):
+    # per candidate LM loss = shared prefix terms + last prefix position predicting the first answer token + suffix terms
+    n_prefix = shape_list(xp)[1]
+    n_suffix = shape_list(xs)[1]
+    lp2 = tf.reshape(tf.tile(lp[:, None], [1, 2]), [-1])
+    p_losses = lm_xent(tf.reshape(hp[:, :-1], [-1, n_embd]), tf.reshape(xp[:, 1:], [-1]), we)
+    p_losses = tf.reshape(p_losses, [-1, n_prefix-1])
+    p_losses = tf.reduce_sum(p_losses*pmask[:, 1:], 1)
+    p_losses = tf.reshape(tf.tile(p_losses[:, None], [1, 2]), [-1])
+    b_h = tf.reshape(tf.tile(batch_gather(hp, lp[:, None]-1), [1, 2, 1]), [-1, n_embd])
+    b_losses = lm_xent(b_h, xs[:, 0], we)
+    s_losses = lm_xent(tf.reshape(hs[:, :-1], [-1, n_embd]), tf.reshape(xs[:, 1:], [-1]), we)
+    s_losses = tf.reduce_sum(tf.reshape(s_losses, [-1, n_suffix-1])*ms[:, 1:], 1)
+    lm_losses = (p_losses+b_losses+s_losses)/(tf.cast(lp2-1, tf.float32)+tf.reduce_sum(ms, 1))
+    # lm_losses.size = [n_batch*2]
+    return lm_losses
+
+def model(X, L, Y=None, train=False, reuse=False, lm=True):
+    # X = tf.placeholder(token_dtype, [n_batch_train/n_gpu, 2, n_ctx])
+    # L = tf.placeholder(tf.int32, [n_batch_train/n_gpu, 2])
     # Y = tf.placeholder(tf.int32, [n_batch_train/n_gpu])
+    # position ids and the padding mask are derived from the sequence lengths L
+    # lm=False leaves out the tied LM head and its loss, Y=None the classifier loss: lm_losses/clf_losses are None
+    # the sequence dimension may be shorter than n_ctx (per-batch padding with --bucket_size)
     with tf.variable_scope('model', reuse=reuse):
         we = tf.get_variable("we", [n_vocab+n_special+n_ctx, n_embd], initializer=tf.random_normal_initializer(stddev=0.02))
-        we = dropout(we, embd_pdrop, train)
-
-        X = tf.reshape(X, [-1, n_ctx, 2])
-        M = tf.reshape(M, [-1, n_ctx])
-
-        h = embed(X, we)
-        # h = tf.placeholder(tf.int32, [-1, n_ctx, 2, n_embd])
-        for layer in range(n_layer):
-            h = block(h, 'h%d'%layer, train=train, scale=True)
-
-        lm_h = tf.reshape(h[:, :-1], [-1, n_embd])
-        # lm_h.size = [n_batch_train/n_gpu * 2 * (n_ctx-1), n_embd]
-        lm_logits = tf.matmul(lm_h, we, transpose_b=True)
-        # lm_logits.size = [n_batch_train/n_gpu * 2 * n_ctx, n_vocab+n_special+n_ctx]
-        lm_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=lm_logits, labels=tf.reshape(X[:, 1:, 0], [-1]))
-        lm_losses = tf.reshape(lm_losses, [shape_list(X)[0], shape_list(X)[1]-1])
-        # lm_losses.size = [n_batch_train/n_gpu * 2, n_ctx-1]
-        lm_losses = tf.reduce_sum(lm_losses*M[:, 1:], 1)/tf.reduce_sum(M[:, 1:], 1)
-        # lm_losses.size = [n_batch_train/n_gpu * 2, 1]
-
-        clf_h = tf.reshape(h, [-1, n_embd])
-        # clf_h.size = [n_batch_train/n_gpu * 2 * n_ctx, n_embd]
-        pool_idx = tf.cast(tf.argmax(tf.cast(tf.equal(X[:, :, 0], clf_token), tf.float32), 1), tf.int32)
-        clf_h = tf.gather(clf_h, tf.range(shape_list(X)[0], dtype=tf.int32)*n_ctx+pool_idx)
+        if not sparse_embd:
+            # element-wise as in the original model, --sparse_embd drops gathered rows in embed()
+            we = dropout(we, embd_pdrop, train)
+
+        n_seq = shape_list(X)[2]
+        X = tf.reshape(tf.cast(X, tf.int32), [-1, n_seq])
+        L = tf.reshape(L, [-1])
+
+        if shared_prefix:
+            clf_h, lm_losses = shared_prefix_forward(X, L, we, train=train, lm=lm)
+        else:
+            h = embed(X, we, train=train)
+            # h.size = [n_batch_train/n_gpu * 2, n_ctx, n_embd]
+            if train and recompute_every > 0:
+                # only the input of every recompute_every blocks is kept for the backward pass
+                step_seed = tf.random_uniform([2], maxval=2**31-1, dtype=tf.int64)
+                for first in range(0, n_layer, recompute_every):
+                    fn = partial(block_segment, layers=range(first, min(first+recompute_every, n_layer)),
+                                 train=train, seed=step_seed+first*1000003)
+                    x = h
+                    h = tf.stop_gradient(fn(x))
+                    recompute_segments.append((fn, x, h))
+            else:
+                for layer in range(n_layer):
+                    h, _ = block(h, 'h%d'%layer, train=train, scale=True)
+
+            if lm:
+                lm_h = tf.reshape(h[:, :-1], [-1, n_embd])
+                # lm_h.size = [n_batch_train/n_gpu * 2 * (n_ctx-1), n_embd]
+                lm_losses = lm_xent(lm_h, tf.reshape(X[:, 1:], [-1]), we)
+                # lm_logits.size = [n_batch_train/n_gpu * 2 * n_ctx, n_vocab+n_special+n_ctx] with the full softmax
+                lm_losses = tf.reshape(lm_losses, [shape_list(X)[0], shape_list(X)[1]-1])
+                # lm_losses.size = [n_batch_train/n_gpu * 2, n_ctx-1]
+                M = tf.sequence_mask(L, n_seq, dtype=tf.float32)
+                lm_losses = tf.reduce_sum(lm_losses*M[:, 1:], 1)/tf.reduce_sum(M[:, 1:], 1)
+                # lm_losses.size = [n_batch_train/n_gpu * 2, 1]
+            else:
+                lm_losses = None
+
+            clf_h = tf.reshape(h, [-1, n_embd])
+            # clf_h.size = [n_batch_train/n_gpu * 2 * n_ctx, n_embd]
+            # the classify token is the last one of every sequence
+            clf_h = tf.gather(clf_h, tf.range(shape_list(X)[0], dtype=tf.int32)*n_seq+L-1)
 
         clf_h = tf.reshape(clf_h, [-1, 2, n_embd])
         # clf_h.size = [n_batch_train/n_gpu, 2, n_embd]
@@ -209,14 +444,19 @@ def model(X, M, Y, train=False, reuse=False):
         # clf_logits.size = [n_batch_train/n_gpu * 2, 1]
         clf_logits = tf.reshape(clf_logits, [-1, 2])
         # clf_logits.size = [n_batch_train/n_gpu, 2]
-        clf_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=clf_logits, labels=Y)
-        # clf_losses.size = [n_batch_train/n_gpu]
+        if Y is not None:
+            clf_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=clf_logits, labels=Y)
+            # clf_losses.size = [n_batch_train/n_gpu]
+        else:
+            clf_losses = None
         return clf_logits, clf_losses, lm_losses
 
-def mgpu_train(*xs):
-    # xs[0]: X_train = tf.placeholder(tf.int32, [n_batch_train, 2, n_ctx, 2])
-    # xs[1]: M_train = tf.placeholder(tf.float32, [n_batch_train, 2, n_ctx])
+def mgpu_train(*xs, grads_in=None):
+    # xs[0]: X_train = tf.placeholder(token_dtype, [n_batch_train, 2, n_ctx])
+    # xs[1]: L_train = tf.placeholder(tf.int32, [n_batch_train, 2])
     # xs[2]: Y_train = tf.placeholder(tf.int32, [n_batch_train])
+    # grads_in: flat gradient placeholder for multi-process training, the second op returned is then the flat
+    # local gradient to be allreduced and fed back through grads_in, accumulation is left to the caller
     gpu_ops = []
     gpu_grads = []
     xs = (tf.split(x, n_gpu, 0) for x in xs)
@@ -225,108 +465,205 @@ def mgpu_train(*xs):
         # i = 3, xs = [xs[0]_i, x[1]_i, x[2]_i]
         do_reuse = True if i > 0 else None
         with tf.device(assign_to_gpu(i, "/gpu:0")), tf.variable_scope(tf.get_variable_scope(), reuse=do_reuse):
-            clf_logits, clf_losses, lm_losses = model(*xs, train=True, reuse=do_reuse)
+            # --lm_coef 0 trains the classifier alone, without the tied LM head
+            clf_logits, clf_losses, lm_losses = model(*xs, train=True, reuse=do_reuse, lm=lm_coef > 0)
             # clf_losses.size = [n_batch_train/n_gpu]
             # clf_logits.size = [n_batch_train/n_gpu, 2]
             # lm_losses.size = [n_batch_train/n_gpu * 2, 1]
 
-            if clf_coef > 0:
-                train_loss = tf.reduce_mean(lm_losses) + clf_coef*tf.reduce_mean(clf_losses)
+            if lm_coef <= 0:
+                train_loss = clf_coef*tf.reduce_mean(clf_losses)
+            elif clf_coef > 0:
+                train_loss = lm_coef*tf.reduce_mean(lm_losses) + clf_coef*tf.reduce_mean(clf_losses)
             else:
-                train_loss = tf.reduce_mean(lm_losses)
+                train_loss = lm_coef*tf.reduce_mean(lm_losses)
             params = find_trainable_variables("model")
-            grads = tf.gradients(train_loss, params)
+            if recompute_segments:
+                grads = recompute_gradients(train_loss, params, recompute_segments)
+                del recompute_segments[:]
+            else:
+                grads = tf.gradients(train_loss, params)
             grads = list(zip(grads, params))
             gpu_grads.append(grads)
             gpu_ops.append([clf_logits, clf_losses, lm_losses])
-    ops = [tf.concat(op, 0) for op in zip(*gpu_ops)]
+    ops = [tf.concat(op, 0) if op[0] is not None else None for op in zip(*gpu_ops)]
     grads = average_grads(gpu_grads)
     grads = [g for g, p in grads]
-    train = opt_fns[opt](params, grads, lr, partial(lr_schedules[lr_schedule], warmup=lr_warmup), n_updates_total, l2=l2, max_grad_norm=max_grad_norm, vector_l2=vector_l2, b1=b1, b2=b2, e=e)
-    return [train]+ops
-
-def mgpu_predict(*xs):
+    if grads_in is not None:
+        accum = flatten_grads(grads, params)
+        grads = unflatten_grads(grads_in, params)
+    elif accum_steps > 1:
+        # accum only sums the gradients of a micro-batch, train adds the last one and applies the mean
+        accum, grads, reset = accumulate(grads, accum_steps)
+    train = opt_fns[opt](params, grads, lr, partial(lr_schedules[lr_schedule], warmup=lr_warmup), n_updates_total, l2=l2, max_grad_norm=max_grad_norm, vector_l2=vector_l2, b1=b1, b2=b2, e=e, lazy=sparse_embd)
+    if grads_in is None and accum_steps > 1:
+        with tf.control_dependencies([train]):
+            train = reset()
+    elif grads_in is None:
+        accum = train
+    return [train, accum]+ops
+
+def mgpu_predict(*xs, lm=True, reuse=True):
+    # xs: (X, L, Y) or (X, L) for logits only, ops that were not built come back as None
+    # reuse=False creates the variables, for inference-only graphs without mgpu_train
     gpu_ops = []
     xs = (tf.split(x, n_gpu, 0) for x in xs)
     for i, xs in enumerate(zip(*xs)):
-        with tf.device(assign_to_gpu(i, "/gpu:0")), tf.variable_scope(tf.get_variable_scope(), reuse=True):
-            clf_logits, clf_losses, lm_losses = model(*xs, train=False, reuse=True)
+        do_reuse = True if reuse or i > 0 else None
+        with tf.device(assign_to_gpu(i, "/gpu:0")), tf.variable_scope(tf.get_variable_scope(), reuse=do_reuse):
+            clf_logits, clf_losses, lm_losses = model(*xs, train=False, reuse=do_reuse, lm=lm)
             gpu_ops.append([clf_logits, clf_losses, lm_losses])
-    ops = [tf.concat(op, 0) for op in zip(*gpu_ops)]
+    ops = [tf.concat(op, 0) if op[0] is not None else None for op in zip(*gpu_ops)]
     return ops
 
-def transform_roc(X1, X2, X3):
-    # X1: [[id1_sen1, id2_sen1, ...], [id1_sen2, id2_sen2], ...]
+def roc_lengths(X1, X2, X3):
+    # length of the longer candidate of each example, special tokens excluded
+    l1 = np.minimum(X1.lengths, max_len)
+    return l1+np.maximum(np.minimum(X2.lengths, max_len), np.minimum(X3.lengths, max_len))
+
+def transform_roc(X1, X2, X3, n_pad=None):
+    # X1: RaggedTokens, X1[i] = [id1_sen_i, id2_sen_i, ...]
+    # candidate j of example i is [start]+x1[:max_len]+[delimiter]+xj[:max_len]+[clf_token],
+    # scattered into xmb with offset arithmetic instead of a loop over examples
+    # n_pad: sequence length to pad to, n_ctx by default
+    # returns token ids xmb: [n_batch, 2, n_pad] and sequence lengths lmb: [n_batch, 2],
+    # model() derives the position ids and the mask from them
     n_batch = len(X1)
-    xmb = np.zeros((n_batch, 2, n_ctx, 2), dtype=np.int32)
-    mmb = np.zeros((n_batch, 2, n_ctx), dtype=np.float32)
+    n_pad = n_pad or n_ctx
+    xmb = np.zeros((n_batch, 2, n_pad), dtype=token_dtype)
+    lmb = np.zeros((n_batch, 2), dtype=np.int32)
     start = encoder['_start_']
     delimiter = encoder['_delimiter_']
-    for i, (x1, x2, x3), in enumerate(zip(X1, X2, X3)):
-        x12 = [start]+x1[:max_len]+[delimiter]+x2[:max_len]+[clf_token]
-        x13 = [start]+x1[:max_len]+[delimiter]+x3[:max_len]+[clf_token]
-        l12 = len(x12)
-        l13 = len(x13)
-        xmb[i, 0, :l12, 0] = x12
-        xmb[i, 1, :l13, 0] = x13
-        mmb[i, 0, :l12] = 1
-        mmb[i, 1, :l13] = 1
-    xmb[:, :, :, 1] = np.arange(n_vocab+n_special, n_vocab+n_special+n_ctx)
-    return xmb, mmb
-
-def iter_apply(Xs, Ms, Ys):
-    fns = [lambda x:np.concatenate(x, 0), lambda x:float(np.sum(x)), lambda x:float(np.sum(x))]
-    results = []
-    for xmb, mmb, ymb in iter_data(Xs, Ms, Ys, n_batch=n_batch_train, truncate=False, verbose=True):
+    rows = np.arange(n_batch)
+    l1 = np.minimum(X1.lengths, max_len)
+    r1, c1, v1 = X1.prefix_index(max_len)
+    for j, Xj in enumerate((X2, X3)):
+        lj = np.minimum(Xj.lengths, max_len)
+        rj, cj, vj = Xj.prefix_index(max_len)
+        xmb[:, j, 0] = start
+        xmb[r1, j, 1+c1] = v1
+        xmb[rows, j, l1+1] = delimiter
+        xmb[rj, j, l1[rj]+2+cj] = vj
+        xmb[rows, j, l1+lj+2] = clf_token
+        lmb[:, j] = l1+lj+3
+    return xmb, lmb
+
+def lazy_roc(X1, X2, X3, *rest):
+    # iter_data transform: pads one batch of ragged examples, labels pass through
+    n_pad = int(roc_lengths(X1, X2, X3).max())+3 if bucket_size > 0 else None
+    return transform_roc(X1, X2, X3, n_pad=n_pad)+tuple(rest)
+
+def trim_roc(xmb, lmb, *rest):
+    # iter_data transform: cuts a batch of n_ctx padded examples down to its longest sequence
+    n_pad = int(lmb.max())
+    return (xmb[:, :, :n_pad], lmb)+tuple(rest)
+
+def eval_batches(lengths):
+    # consecutive batches over the examples sorted by length, results come back in sorted order
+    order = np.argsort(lengths, kind='stable')
+    return order, [order[i:i+n_batch_train] for i in range(0, len(order), n_batch_train)]
+
+def input_batches(*datas, **kwargs):
+    # iter_data batches, prepared --n_prefetch batches ahead by a background thread
+    return Prefetcher(iter_data(*datas, **kwargs), n_prefetch)
+
+def pad_batch(n, *mbs):
+    # fill a partial batch up to n_batch_train by repeating its last example, so it runs through the
+    # same fixed-size graph as the full batches, results of the padding rows are dropped by the caller
+    return tuple(np.concatenate([mb, np.repeat(mb[-1:], n_batch_train-n, 0)], 0) if n < n_batch_train else mb for mb in mbs)
+
+def iter_apply(*datas, lengths=None):
+    # datas: (Xs, Ls, Ys), or (X1s, X2s, X3s, Ys) with --lazy_transform
+    # lengths: per-example sequence lengths, with --bucket_size examples are batched by length
+    # returns the logits and the summed classifier and LM costs (per example, the LM cost averaged over both candidates)
+    logits, clf_cost, lm_cost = [], 0., 0.
+    order, batches = eval_batches(lengths) if bucket_size > 0 else (None, None)
+    for xmb, lmb, ymb in input_batches(*datas, n_batch=n_batch_train, truncate=False, verbose=True, transform=batch_transform, batches=batches):
         n = len(xmb)
-        if n == n_batch_train:
-            res = sess.run([eval_mgpu_logits, eval_mgpu_clf_loss, eval_mgpu_lm_loss],
-                           {X_train:xmb, M_train:mmb, Y_train:ymb})
-        else:
-            res = sess.run([eval_logits, eval_clf_loss, eval_lm_loss],
-                           {X:xmb, M:mmb, Y:ymb})
-        res = [r*n for r in res]
-        results.append(res)
-    results = zip(*results)
-    # results = [(eval_mgpu_logits1*n, eval_mgpu_logits2*n...), (eval_mgpu_clf_loss1*n, eval_mgpu_clf_loss2*n...),
-    #            (eval_mgpu_lm_loss1*n, eval_mgpu_lm_loss2*n...)]
-    return [fn(res) for res, fn in zip(results, fns)]
-
-def iter_predict(Xs, Ms):
+        xmb, lmb, ymb = pad_batch(n, xmb, lmb, ymb)
+        res = sess.run(eval_mgpu_ops, {X_train:xmb, L_train:lmb, Y_train:ymb})
+        logits.append(res[0][:n])
+        clf_cost += float(np.sum(res[1][:n]))
+        if not skip_lm_eval:
+            # two LM rows per example
+            lm_cost += float(np.sum(res[2][:2*n]))/2
+    logits = np.concatenate(logits, 0)
+    if order is not None:
+        logits[order] = logits.copy()
+    # no LM cost with --skip_lm_eval
+    return logits, clf_cost, None if skip_lm_eval else lm_cost
+
+def iter_predict(*datas, lengths=None):
+    # datas: (Xs, Ls), or (X1s, X2s, X3s) with --lazy_transform
     logits = []
-    for xmb, mmb in iter_data(Xs, Ms, n_batch=n_batch_train, truncate=False, verbose=True):
+    order, batches = eval_batches(lengths) if bucket_size > 0 else (None, None)
+    for xmb, lmb in input_batches(*datas, n_batch=n_batch_train, truncate=False, verbose=True, transform=batch_transform, batches=batches):
         n = len(xmb)
-        if n == n_batch_train:
-            logits.append(sess.run(eval_mgpu_logits, {X_train:xmb, M_train:mmb}))
-        else:
-            logits.append(sess.run(eval_logits, {X:xmb, M:mmb}))
+        xmb, lmb = pad_batch(n, xmb, lmb)
+        logits.append(sess.run(eval_mgpu_logits, {X_train:xmb, L_train:lmb})[:n])
     logits = np.concatenate(logits, 0)
+    if order is not None:
+        logits[order] = logits.copy()
     return logits
 
 def save(path):
+    import joblib
     ps = sess.run(params)
     joblib.dump(ps, make_path(path))
 
-def log():
-    global best_ppl
-    tr_clf_logits, tr_clf_cost, tr_lm_cost = iter_apply(trX[:n_valid], trM[:n_valid], trY[:n_valid])
-    va_clf_logits, va_clf_cost, va_lm_cost = iter_apply(vaX, vaM, vaY)
-    tr_cost = tr_lm_cost/len(trY[:n_valid])
-    va_cost = va_lm_cost/n_valid
-    tr_acc = accuracy_score(trY[:n_valid], np.argmax(tr_clf_logits, 1))*100.
-    va_acc = accuracy_score(vaY, np.argmax(va_clf_logits, 1))*100.
+# the python side of the training state, saved next to every checkpoint
+train_state_keys = ['n_updates', 'n_micro', 'n_epochs', 'n_batch_cursor', 'best_ppl', 'best_acc', 'best_checkpoint', 'step_time',
+                    'input_wait', 'tr_running']
+
+def train_state():
+    state = {k:globals()[k] for k in train_state_keys}
+    # the epoch order only depends on (seed, n_epochs), the global generators are saved for everything else
+    py_random = random.getstate()
+    np_random = np.random.get_state()
+    state['py_random'] = [py_random[0], list(py_random[1])]+list(py_random[2:])
+    state['np_random'] = [np_random[0], np_random[1].tolist()]+[float(x) if isinstance(x, float) else int(x) for x in np_random[2:]]
+    return {k:float(v) if isinstance(v, np.floating) else v for k, v in state.items()}
+
+def log(full=True):
+    # full: evaluate the whole validation set, otherwise with --eval_budget only a fixed subsample of it
+    global best_ppl, best_acc, best_checkpoint, tr_running
+    from sklearn.metrics import accuracy_score
+    if eval_budget > 0:
+        # training metrics accumulated from the training steps since the last log
+        n, tr_lm_cost, tr_correct = tr_running
+        tr_running = [0, 0., 0]
+        tr_cost = tr_lm_cost/max(n, 1) if lm_coef > 0 else float('nan')
+        tr_acc = 100.*tr_correct/max(n, 1)
+    else:
+        tr_clf_logits, tr_clf_cost, tr_lm_cost = iter_apply(*[d[:n_valid] for d in tr_data], lengths=tr_lengths[:n_valid])
+        tr_cost = float('nan') if skip_lm_eval else tr_lm_cost/len(trY[:n_valid])
+        tr_acc = accuracy_score(trY[:n_valid], np.argmax(tr_clf_logits, 1))*100.
+    va_eval, va_eval_lengths = (va_data, va_lengths) if full or eval_budget <= 0 else (va_sub, va_sub_lengths)
+    va_clf_logits, va_clf_cost, va_lm_cost = iter_apply(*va_eval, lengths=va_eval_lengths)
+    va_cost = float('nan') if skip_lm_eval else va_lm_cost/len(va_eval[-1])
+    va_acc = accuracy_score(va_eval[-1], np.argmax(va_clf_logits, 1))*100.
     logger.log(n_epochs=n_epochs, n_updates=n_updates, tr_cost=np.exp(tr_cost),
-               va_cost=np.exp(va_cost), tr_acc=tr_acc, va_acc=va_acc)
-    print('\nn_epochs: %d , n_updates: %d , tr_ppl: %.3f , va_ppl: %.3f , tr_clf_acc: %.2f , val_clf_acc: %.2f\n'
-          %(n_epochs, n_updates, np.exp(tr_cost), np.exp(va_cost), tr_acc, va_acc))
+               va_cost=np.exp(va_cost), tr_acc=tr_acc, va_acc=va_acc, step_time=step_time, input_wait=input_wait, full=full)
+    print('\nn_epochs: %d , n_updates: %d , tr_ppl: %.3f , va_ppl: %.3f , tr_clf_acc: %.2f , val_clf_acc: %.2f , input_wait: %.1f%%\n'
+          %(n_epochs, n_updates, np.exp(tr_cost), np.exp(va_cost), tr_acc, va_acc, 100.*input_wait/max(step_time+input_wait, 1e-8)))
+    if not (full or eval_budget <= 0):
+        # the best model is only chosen on the full validation set
+        return
 
     ppl = np.exp(va_cost)
 
-    if ppl < best_ppl or best_ppl < 0:
+    if skip_lm_eval:
+        # no perplexity without the LM head, the best model is the most accurate one
+        is_best = va_acc > best_acc
+    else:
+        is_best = ppl < best_ppl or best_ppl < 0
+    if is_best:
         best_ppl = ppl
-        best_sv_name = os.path.join(save_dir, desc + '-best')
+        best_acc = va_acc
+        # recorded in the training state so that a resumed run keeps it out of the rotation
+        best_checkpoint = os.path.join(save_dir, '%s-best-%d' % (desc, n_updates))
         print("Saving best model to %s." % save_dir)
-        sv.save(sess, best_sv_name)
+        ckpt_writer.save(sess, best_checkpoint, best=True, state=train_state())
         # save(os.path.join(save_dir, desc, 'best_params.jl'))
 
 argmax = lambda x:np.argmax(x, 1)
@@ -347,7 +684,7 @@ def predict():
     filename = filenames[dataset]
     pred_fn = pred_fns[dataset]
     label_decoder = label_decoders[dataset]
-    predictions = pred_fn(iter_predict(teX, teM))
+    predictions = pred_fn(iter_predict(*te_data, lengths=te_lengths))
     if label_decoder is not None:
         predictions = [label_decoder[prediction] for prediction in predictions]
     path = os.path.join(submission_dir, filename)
@@ -358,7 +695,7 @@ def predict():
             f.write('{}\t{}\n'.format(i, prediction))
 
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--desc', type=str, default='gpt-baike-qa')
     parser.add_argument('--dataset', type=str)
@@ -366,11 +703,29 @@ if __name__ == '__main__':
     parser.add_argument('--save_dir', type=str, default='save/')
     parser.add_argument('--data_dir', type=str, default='baike_qa2019/')
     parser.add_argument('--submission_dir', type=str, default='submission/')
+    parser.add_argument('--cache_dir', type=str, default='cache/')
+    parser.add_argument('--n_proc', type=int, default=None)
+    parser.add_argument('--lazy_transform', action='store_true')
     parser.add_argument('--submit', action='store_true')
+    parser.add_argument('--keep_checkpoints', type=int, default=5)
     parser.add_argument('--analysis', action='store_true')
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--n_iter', type=int, default=1)
+    parser.add_argument('--bucket_size', type=int, default=0)
+    parser.add_argument('--n_prefetch', type=int, default=2)
+    parser.add_argument('--shared_prefix', action='store_true')
+    parser.add_argument('--skip_lm_eval', action='store_true')
+    parser.add_argument('--eval_budget', type=int, default=0)
+    parser.add_argument('--adaptive_softmax', type=str, default='')
+    parser.add_argument('--attn_impl', type=str, default='dense', choices=['dense', 'chunked'])
+    parser.add_argument('--attn_block', type=int, default=64)
+    parser.add_argument('--recompute_every', type=int, default=0)
     parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--accum_steps', type=int, default=1)
+    parser.add_argument('--dist_world_size', type=int, default=1)
+    parser.add_argument('--dist_rank', type=int, default=0)
+    parser.add_argument('--dist_hosts', type=str, default='')
+    parser.add_argument('--dist_port', type=int, default=29500)
     parser.add_argument('--max_grad_norm', type=int, default=1)
     parser.add_argument('--lr', type=float, default=6.25e-5)
     parser.add_argument('--lr_warmup', type=float, default=0.002)
@@ -379,6 +734,7 @@ if __name__ == '__main__':
     parser.add_argument('--n_head', type=int, default=2)
     parser.add_argument('--n_layer', type=int, default=2)
     parser.add_argument('--embd_pdrop', type=float, default=0.1)
+    parser.add_argument('--sparse_embd', action='store_true')
     parser.add_argument('--attn_pdrop', type=float, default=0.1)
     parser.add_argument('--resid_pdrop', type=float, default=0.1)
     parser.add_argument('--clf_pdrop', type=float, default=0.1)
@@ -390,28 +746,34 @@ if __name__ == '__main__':
     parser.add_argument('--lr_schedule', type=str, default='warmup_linear')
     parser.add_argument('--encoder_path', type=str, default='baike_qa2019/vocab.json')
     parser.add_argument('--clf_coef', type=float, default=0.5)
+    parser.add_argument('--lm_coef', type=float, default=1.)
     parser.add_argument('--b1', type=float, default=0.9)
     parser.add_argument('--b2', type=float, default=0.999)
     parser.add_argument('--e', type=float, default=1e-8)
+    return parser
 
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
     print(args)
     globals().update(args.__dict__)
+    assert not (recompute_every > 0 and shared_prefix), '--recompute_every is not supported with --shared_prefix'
     random.seed(seed)
     np.random.seed(seed)
     tf.set_random_seed(seed)
 
-    logger = ResultLogger(path=os.path.join(log_dir, '{}.jsonl'.format(desc)), **args.__dict__)
+    # every worker trains on its own share of each epoch, rank 0 alone evaluates, logs and saves
+    ring = Ring(dist_rank, dist_world_size, hosts=[h for h in dist_hosts.split(',') if h], port=dist_port)
+    is_chief = dist_rank == 0
+    if is_chief:
+        logger = ResultLogger(path=os.path.join(log_dir, '{}.jsonl'.format(desc)), **args.__dict__)
     text_encoder = TextEncoder(encoder_path)
     encoder = text_encoder.encoder
     # encoder = json.load(open(encoder_path)), ex. {".": 1, ",": 2, "t": 3, "h": 4, ...}
     n_vocab = len(text_encoder.encoder)
     print('vocab size: ', n_vocab)
 
-    (trX1, trX2, trX3, trY), (vaX1, vaX2, vaX3, vaY), (teX1, teX2, teX3) = encode_dataset(data_process(data_dir),
-                                                                                          encoder=text_encoder)
-    # trX1/trX2/trX3: [[id1_sen1, id2_sen1,...],[id1_sen2, id2_sen2],...]
-    # trY: [0, 1, 1,....]
     n_y = 2
     encoder['_start_'] = len(encoder)
     encoder['_delimiter_'] = len(encoder)
@@ -419,32 +781,79 @@ if __name__ == '__main__':
     clf_token = encoder['_classify_']
     n_special = 3
     max_len = n_ctx//2-2
-    n_ctx = min(max([len(x1[:max_len])+max(len(x2[:max_len]), len(x3[:max_len])) for x1, x2, x3 in zip(trX1, trX2, trX3)]+[len(x1[:max_len])+max(len(x2[:max_len]), len(x3[:max_len])) for x1, x2, x3 in zip(vaX1, vaX2, vaX3)]+[len(x1[:max_len])+max(len(x2[:max_len]), len(x3[:max_len])) for x1, x2, x3 in zip(teX1, teX2, teX3)])+3, n_ctx)
-    trX, trM = transform_roc(trX1, trX2, trX3)
-    # trX: [n_batch, 2, n_ctx, 2], dtype=np.int32
-    # trM: [n_batch, 2, n_ctx], dtype=np.float32
-    vaX, vaM = transform_roc(vaX1, vaX2, vaX3)
-    teX, teM = transform_roc(teX1, teX2, teX3)
+    # token ids are stored as uint16 whenever the vocab fits
+    token_dtype = np.uint16 if n_vocab+n_special <= np.iinfo(np.uint16).max+1 else np.int32
+    # cluster boundaries of the adaptive LM softmax, e.g. --adaptive_softmax 2000,10000
+    lm_cutoffs = sorted(int(c) for c in adaptive_softmax.split(',') if c and 0 < int(c) < n_vocab)
+
+    data_key = cache_key([os.path.join(data_dir, 'baike_qa_train.json'), os.path.join(data_dir, 'baike_qa_test.json'), encoder_path],
+                         n_ctx=n_ctx, max_len=max_len, lazy_transform=lazy_transform, layout='tokens+lengths', seed=seed)
+    cached = load_arrays(cache_dir, data_key) if cache_dir else None
+    if cached is not None:
+        print("Reading data from %s" % os.path.join(cache_dir, data_key))
+        arrays, meta = cached
+        n_ctx = meta['n_ctx']
+    else:
+        (trX1, trX2, trX3, trY), (vaX1, vaX2, vaX3, vaY), (teX1, teX2, teX3) = encode_dataset(data_process(data_dir, seed=seed, n_proc=n_proc),
+                                                                                              encoder=text_encoder)
+        # trX1/trX2/trX3: RaggedTokens, trX1[i] = [id1_sen_i, id2_sen_i,...]
+        # trY: [0, 1, 1,....]
+        n_ctx = min(int(max(roc_lengths(trX1, trX2, trX3).max(), roc_lengths(vaX1, vaX2, vaX3).max(), roc_lengths(teX1, teX2, teX3).max()))+3, n_ctx)
+        if lazy_transform:
+            # keep the ragged buffers, batches are padded on the fly by lazy_roc
+            arrays = dict(trX1=trX1, trX2=trX2, trX3=trX3, trY=trY, vaX1=vaX1, vaX2=vaX2, vaX3=vaX3, vaY=vaY,
+                          teX1=teX1, teX2=teX2, teX3=teX3)
+        else:
+            trX, trL = transform_roc(trX1, trX2, trX3)
+            # trX: [n_batch, 2, n_ctx], dtype=token_dtype
+            # trL: [n_batch, 2], dtype=np.int32
+            vaX, vaL = transform_roc(vaX1, vaX2, vaX3)
+            teX, teL = transform_roc(teX1, teX2, teX3)
+            arrays = dict(trX=trX, trL=trL, trY=trY, vaX=vaX, vaL=vaL, vaY=vaY, teX=teX, teL=teL)
+        if cache_dir:
+            save_arrays(cache_dir, data_key, arrays, meta=dict(n_ctx=n_ctx))
+
+    if lazy_transform:
+        tr_data = (arrays['trX1'], arrays['trX2'], arrays['trX3'], arrays['trY'])
+        va_data = (arrays['vaX1'], arrays['vaX2'], arrays['vaX3'], arrays['vaY'])
+        te_data = (arrays['teX1'], arrays['teX2'], arrays['teX3'])
+        tr_lengths, va_lengths, te_lengths = [roc_lengths(*d[:3])+3 for d in (tr_data, va_data, te_data)]
+        batch_transform = lazy_roc
+    else:
+        tr_data = (arrays['trX'], arrays['trL'], arrays['trY'])
+        va_data = (arrays['vaX'], arrays['vaL'], arrays['vaY'])
+        te_data = (arrays['teX'], arrays['teL'])
+        tr_lengths, va_lengths, te_lengths = [np.asarray(d[1]).max(1) for d in (tr_data, va_data, te_data)]
+        batch_transform = trim_roc if bucket_size > 0 else None
+    trY = tr_data[-1]
+    vaY = va_data[-1]
 
     n_train = len(trY)
     n_valid = len(vaY)
     n_batch_train = n_batch*n_gpu
-    n_updates_total = (n_train//n_batch_train)*n_iter
-
-    X_train = tf.placeholder(tf.int32, [n_batch_train, 2, n_ctx, 2])
-    M_train = tf.placeholder(tf.float32, [n_batch_train, 2, n_ctx])
-    X = tf.placeholder(tf.int32, [None, 2, n_ctx, 2])
-    M = tf.placeholder(tf.float32, [None, 2, n_ctx])
+    if is_chief:
+        # what predict.py needs to rebuild the inference graph and the test data without the training setup
+        write_manifest(os.path.join(save_dir, 'manifest.json'), args=args.__dict__, n_ctx=n_ctx, n_vocab=n_vocab,
+                       n_special=n_special, max_len=max_len, token_dtype=np.dtype(token_dtype).name, n_train=n_train,
+                       special_tokens={k:encoder[k] for k in ['_start_', '_delimiter_', '_classify_']})
+    # one optimizer update every accum_steps micro-batches of n_batch_train examples
+    n_updates_total = (n_train//(n_batch_train*accum_steps*dist_world_size))*n_iter
+
+    # with --bucket_size every batch is padded to its own longest sequence
+    n_seq = None if bucket_size > 0 else n_ctx
+    X_train = tf.placeholder(tf.as_dtype(token_dtype), [n_batch_train, 2, n_seq])
+    L_train = tf.placeholder(tf.int32, [n_batch_train, 2])
 
     Y_train = tf.placeholder(tf.int32, [n_batch_train])
-    Y = tf.placeholder(tf.int32, [None])
 
-    train, logits, clf_losses, lm_losses = mgpu_train(X_train, M_train, Y_train)
+    # with several workers the gradients leave the graph to be allreduced and come back through G
+    G = tf.placeholder(tf.float32, [None]) if dist_world_size > 1 else None
+    train, accum, logits, clf_losses, lm_losses = mgpu_train(X_train, L_train, Y_train, grads_in=G)
     # clf_losses.size = [n_batch_train]
     # clf_logits.size = [n_batch_train, 2]
     # lm_losses.size = [n_batch_train * 2, 1]
     clf_loss = tf.reduce_mean(clf_losses)
-    lm_loss = tf.reduce_mean(lm_losses)
+    lm_loss = tf.reduce_mean(lm_losses) if lm_losses is not None else clf_loss
 
     sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
     sess.run(tf.global_variables_initializer())
@@ -455,36 +864,123 @@ if __name__ == '__main__':
         restore_v[v.name] = v
     params = find_trainable_variables("model")
     sv = tf.train.Saver(restore_v)
+    # checkpoints hold the whole training state: the weights, the optimizer moments and step, the accumulation buffers
+    state_v = {v.name:v for v in tf.global_variables()}
+    state = None
     ckpt = tf.train.get_checkpoint_state(save_dir)
     if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
         print("Reading param from %s" % ckpt.model_checkpoint_path)
-        sv.restore(sess, ckpt.model_checkpoint_path)
+        try:
+            tf.train.Saver(state_v).restore(sess, ckpt.model_checkpoint_path)
+            state = load_state(ckpt.model_checkpoint_path)
+        except tf.errors.NotFoundError:
+            # a weights only checkpoint, the optimizer starts over
+            print("No optimizer state in %s, restoring the weights only" % ckpt.model_checkpoint_path)
+            sv.restore(sess, ckpt.model_checkpoint_path)
     else:
         print("Created model with fresh param.")
 
-    if not os.path.isdir(save_dir):
-        os.makedirs(save_dir)
+    if dist_world_size > 1:
+        # every worker starts from the weights of rank 0
+        for v in tf.global_variables():
+            # 0-d variables (the Adam step t) travel as one element arrays, a fresh writable copy each
+            value = ring.broadcast(np.array(sess.run(v), copy=True, ndmin=1))
+            v.load(value.reshape(v.get_shape().as_list()), sess)
+        print("Synchronized %d variables from rank 0" % len(tf.global_variables()))
+        grad_sum = None
 
-    eval_mgpu_logits, eval_mgpu_clf_losses, eval_mgpu_lm_losses = mgpu_predict(X_train, M_train, Y_train)
-    eval_mgpu_clf_loss = tf.reduce_mean(eval_mgpu_clf_losses)
-    eval_mgpu_lm_loss = tf.reduce_mean(eval_mgpu_lm_losses)
-
-    eval_logits, eval_clf_losses, eval_lm_losses = model(X, M, Y, train=False, reuse=True)
-    eval_clf_loss = tf.reduce_mean(eval_clf_losses)
-    eval_lm_loss = tf.reduce_mean(eval_lm_losses)
+    if is_chief and not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    if is_chief:
+        # checkpoints are written in the background, sv only restores
+        ckpt_writer = CheckpointWriter(state_v, save_dir, max_to_keep=keep_checkpoints,
+                                       best=state.get('best_checkpoint') if state else None)
+
+    # evaluation only builds the LM head when log() asks for perplexities, predict() only fetches the logits
+    eval_mgpu_logits, eval_mgpu_clf_losses, eval_mgpu_lm_losses = mgpu_predict(X_train, L_train, Y_train, lm=not skip_lm_eval)
+    # per-example losses, partial batches are padded to n_batch_train and their padding rows dropped
+    eval_mgpu_ops = [eval_mgpu_logits, eval_mgpu_clf_losses]
+    if not skip_lm_eval:
+        eval_mgpu_ops.append(eval_mgpu_lm_losses)
+
+    # with --eval_budget the periodic logs evaluate a fixed random subsample of the validation set
+    if eval_budget > 0:
+        va_sample = np.sort(np.random.RandomState(seed).permutation(n_valid)[:eval_budget])
+        va_sub = tuple(d[va_sample] for d in va_data)
+        va_sub_lengths = va_lengths[va_sample]
+    # [examples, summed LM loss, correct predictions] of the training steps since the last log
+    tr_running = [0, 0., 0]
 
     n_updates = 0
+    # micro-batches trained on, gradients of a partial accumulation carry over into the next epoch
+    n_micro = 0
     n_epochs = 0
+    # batches of the current epoch already trained on
+    n_batch_cursor = 0
 
     best_ppl = -1
-    for i in range(n_iter):
-        for xmb, mmb, ymb in iter_data(*shuffle(trX, trM, trY, random_state=np.random), n_batch=n_batch_train, truncate=True, verbose=True):
-            cost, _ = sess.run([lm_loss, train], {X_train:xmb, M_train:mmb, Y_train:ymb})
+    best_acc = -1
+    best_checkpoint = None
+    # seconds spent in sess.run for training steps and waiting for their input batches
+    step_time = 0.
+    input_wait = 0.
+    epoch_input_wait = 0.
+    if state is not None:
+        print("Resuming at epoch %d, batch %d, update %d" % (state['n_epochs'], state['n_batch_cursor'], state['n_updates']))
+        globals().update({k:v for k, v in state.items() if k in train_state_keys})
+        random.setstate(tuple(state['py_random'][:1])+(tuple(state['py_random'][1]),)+tuple(state['py_random'][2:]))
+        np.random.set_state(tuple(state['np_random'][:1])+(np.asarray(state['np_random'][1], dtype=np.uint32),)+tuple(state['np_random'][2:]))
+        epoch_input_wait = input_wait
+    if dist_world_size > 1:
+        # the data cursor of rank 0 wins, as its weights did
+        cursor = ring.broadcast(np.array([n_updates, n_micro, n_epochs, n_batch_cursor], dtype=np.float64))
+        n_updates, n_micro, n_epochs, n_batch_cursor = [int(c) for c in cursor]
+    while n_epochs < n_iter:
+        # batches are gathered by index from the (memory-mapped) training arrays, no shuffled copy is made
+        rng = epoch_random_state(seed, n_epochs)
+        if bucket_size > 0:
+            batches = bucket_batches(tr_lengths, n_batch_train, bucket_size, truncate=True, random_state=rng)
+        else:
+            batches = shuffle_batches(n_train, n_batch_train, truncate=True, random_state=rng)
+        if dist_world_size > 1:
+            # the same epoch order on every worker, dealt out round robin in equal shares
+            batches = batches[:len(batches)//dist_world_size*dist_world_size][dist_rank::dist_world_size]
+        tr_batches = input_batches(*tr_data, n_batch=n_batch_train, truncate=True, verbose=True, transform=batch_transform,
+                                   batches=batches, start=n_batch_cursor)
+        for xmb, lmb, ymb in tr_batches:
+            n_micro += 1
+            update = n_micro % accum_steps == 0
+            t = time.time()
+            if dist_world_size > 1:
+                cost, tr_logits, g = sess.run([lm_loss, logits, accum], {X_train:xmb, L_train:lmb, Y_train:ymb})
+                grad_sum = g if grad_sum is None else np.add(grad_sum, g, out=grad_sum)
+                if update:
+                    ring.allreduce(grad_sum)
+                    sess.run(train, {G:grad_sum/(accum_steps*dist_world_size)})
+                    grad_sum = None
+            else:
+                cost, tr_logits, _ = sess.run([lm_loss, logits, train if update else accum], {X_train:xmb, L_train:lmb, Y_train:ymb})
+            step_time += time.time()-t
+            tr_running[0] += len(ymb)
+            tr_running[1] += float(cost)*len(ymb)
+            tr_running[2] += int(np.sum(np.argmax(tr_logits, 1) == ymb))
+            input_wait = epoch_input_wait+tr_batches.wait_time
+            n_batch_cursor += 1
+            if not update:
+                continue
             n_updates += 1
-            if n_updates % (max((n_train//n_batch_train) // 10, 1)) == 0:
-                log()
+            if not is_chief:
+                continue
+            if n_updates % (max((n_train//(n_batch_train*accum_steps*dist_world_size)) // 10, 1)) == 0:
+                log(full=False)
                 sv_name = os.path.join(save_dir, desc)
                 print("Saving model to %s." % save_dir)
-                sv.save(sess, sv_name, global_step=n_updates)
+                ckpt_writer.save(sess, sv_name, global_step=n_updates, state=train_state())
+        epoch_input_wait += tr_batches.wait_time
+        n_batch_cursor = 0
         n_epochs += 1
-        log()
+        if is_chief:
+            log()
+    if is_chief:
+        ckpt_writer.close()
+    ring.close()
@@ -10,6 +10,8 @@ import sys
 import json
 import math
 import time
+import queue
+import threading
 import unicodedata
 import numpy as np
 import tensorflow as tf
@@ -22,19 +24,30 @@ def encode_dataset(*splits, encoder):
     # input : (trX1, trX2, trX3, trY), (vaX1, vaX2, vaX3, vaY), (teX1, teX2, teX3)
     # (trX1, trX2, trX3, trY) = ([sentence1, sentence2...],[quiz1_1, quiz1_2....],[quiz2_1, quiz2_2...],[0,1,1,0.....])
     encoded_splits = []
+    encoded = {}
     for split in splits[0]:
         # (trX1, trX2, trX3, trY)
         fields = []
         for field in split:
             # trX1: [sentence1, sentence2...]
             if isinstance(field[0], str):
-                field = encoder.encode(field)
-                # field = [[id1_sen1, id2_sen2,...],[id1_sen2, id2_sen2],...]
+                # splits may share a field (test reuses the validation texts), encode it once
+                if id(field) not in encoded:
+                    encoded[id(field)] = encoder.encode_ragged(field)
+                field = encoded[id(field)]
+                # field = RaggedTokens, field[i] = [id1_sen_i, id2_sen_i,...]
             fields.append(field)
-            # fields = [[[id1_sen1_trX1, id2_sen2_trX1,...],[id1_sen2_trX1, id2_sen2_trX1],...],...]
+            # fields = [RaggedTokens_trX1, RaggedTokens_trX2, RaggedTokens_trX3, trY]
         encoded_splits.append(fields)
     return encoded_splits
-    # encoded_splits = [[[[id1_sen1_trX1, id2_sen2_trX1,...],[id1_sen2_trX1, id2_sen2_trX1],...],...]....]
+    # encoded_splits = [[RaggedTokens_trX1, RaggedTokens_trX2, RaggedTokens_trX3, trY], ...]
+
+def write_manifest(path, **manifest):
+    # json description of a run, written atomically next to its checkpoints
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(make_path(tmp_path), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
 
 def stsb_label_encoding(labels, nclass=6):
     """
@@ -57,6 +70,14 @@ def shape_list(x):
     ts = tf.shape(x)
     return [ts[i] if ps[i] is None else ps[i] for i in range(len(ps))]
 
+def batch_gather(x, idx):
+    """
+    x: [batch, n, ...], idx: [batch, k] -> [batch, k, ...] with out[b, i] = x[b, idx[b, i]]
+    """
+    idx_shape = shape_list(idx)
+    b = tf.tile(tf.range(idx_shape[0])[:, None], [1, idx_shape[1]])
+    return tf.gather_nd(x, tf.stack([b, idx], -1))
+
 def np_softmax(x, t=1):
     x = x/t
     x = x - np.max(x, axis=-1, keepdims=True)
@@ -110,28 +131,141 @@ def flatten(outer):
 def remove_none(l):
     return [e for e in l if e is not None]
 
-def iter_data(*datas, n_batch=128, truncate=False, verbose=False, max_batches=float("inf")):
-    # trX: [n_batch, 2, n_ctx, 2], dtype=np.int32
-    # trM: [n_batch, 2, n_ctx], dtype=np.float32
-    # trY: [n_batch], dtype=np.int32
-    n = len(datas[0])
-
+def shuffle_batches(n, n_batch, truncate=False, random_state=np.random):
+    """
+    index batches of a random permutation of range(n), sorted within a batch so that
+    gathering from memory-mapped arrays reads forward through the file
+    """
+    perm = random_state.permutation(n)
     if truncate:
-        n = (n//n_batch)*n_batch
-    n = min(n, max_batches*n_batch)
+        perm = perm[:(n//n_batch)*n_batch]
+    return [np.sort(perm[i:i+n_batch]) for i in range(0, len(perm), n_batch)]
+
+def epoch_random_state(seed, epoch):
+    # the batch order of an epoch only depends on (seed, epoch), so it can be rebuilt to resume mid-epoch
+    return np.random.RandomState([seed, epoch])
+
+def bucket_batches(lengths, n_batch, bucket_size=100, truncate=False, random_state=np.random):
+    """
+    index batches of examples with similar lengths: shuffle, sort chunks of bucket_size batches by length,
+    cut them into batches and shuffle the batch order
+    """
+    n = len(lengths)
+    perm = random_state.permutation(n)
+    chunk = n_batch*bucket_size
+    batches = []
+    for i in range(0, n, chunk):
+        idx = perm[i:i+chunk]
+        idx = idx[np.argsort(lengths[idx], kind='stable')]
+        for j in range(0, len(idx), n_batch):
+            if truncate and len(idx)-j < n_batch:
+                break
+            batches.append(idx[j:j+n_batch])
+    return [batches[i] for i in random_state.permutation(len(batches))]
+
+def iter_data(*datas, n_batch=128, truncate=False, verbose=False, max_batches=float("inf"), transform=None, batches=None, start=0):
+    # trX: [n_batch, 2, n_ctx], token ids
+    # trL: [n_batch, 2], dtype=np.int32
+    # trY: [n_batch], dtype=np.int32
+    # transform: applied to every batch of datas, e.g. to pad ragged token buffers into trX/trL batch by batch
+    # batches: index arrays to gather batches from instead of consecutive slices, e.g. from shuffle_batches
+    # start: number of batches to skip, the cursor of a resumed epoch
+    if batches is None:
+        n = len(datas[0])
+        if truncate:
+            n = (n//n_batch)*n_batch
+        n = min(n, max_batches*n_batch)
+        batches = [slice(i, i+n_batch) for i in range(0, n, n_batch)]
+    batches = batches[start:]
     n_batches = 0
     if verbose:
         f = sys.stderr
     else:
         f = open(os.devnull, 'w')
-    for i in tqdm(range(0, n, n_batch), total=n//n_batch, file=f, ncols=80, leave=False):
-        if n_batches >= max_batches: raise StopIteration
-        if len(datas) == 1:
-            yield datas[0][i:i+n_batch]
+    for idx in tqdm(batches, total=len(batches), file=f, ncols=80, leave=False):
+        if n_batches >= max_batches: return
+        batch = [d[idx] for d in datas]
+        if transform is not None:
+            batch = transform(*batch)
+        if len(batch) == 1:
+            yield batch[0]
         else:
-            yield (d[i:i+n_batch] for d in datas)
+            yield batch
         n_batches += 1
 
+class Prefetcher(object):
+    """
+    iterate over the batches of an iterable prepared up to n_prefetch steps ahead by a background thread,
+    n_prefetch=0 iterates in the calling thread. wait_time sums the seconds the consumer spent waiting for input
+    """
+
+    _end = object()
+
+    def __init__(self, iterable, n_prefetch=2):
+        self.iterable = iterable
+        self.n_prefetch = n_prefetch
+        self.wait_time = 0.
+        self.n_batches = 0
+        self._stop = threading.Event()
+        if n_prefetch > 0:
+            self._queue = queue.Queue(maxsize=n_prefetch)
+            self._thread = threading.Thread(target=self._produce, daemon=True)
+            self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for batch in self.iterable:
+                # copy memory-mapped slices to contiguous host memory here rather than in the training thread
+                if isinstance(batch, (list, tuple)):
+                    batch = [np.ascontiguousarray(b) for b in batch]
+                else:
+                    batch = np.ascontiguousarray(batch)
+                if not self._put(batch):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._end)
+
+    def __iter__(self):
+        if self.n_prefetch <= 0:
+            it = iter(self.iterable)
+            while True:
+                t = time.time()
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    return
+                self.wait_time += time.time()-t
+                self.n_batches += 1
+                yield batch
+        else:
+            try:
+                while True:
+                    t = time.time()
+                    item = self._queue.get()
+                    self.wait_time += time.time()-t
+                    if item is self._end:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    self.n_batches += 1
+                    yield item
+            finally:
+                self.close()
+
+    def close(self):
+        self._stop.set()
+
 @function.Defun(
     python_grad_func=lambda x, dy: tf.convert_to_tensor(dy),
     shape_func=lambda op: [op.inputs[0].get_shape()])
@@ -150,6 +284,33 @@ def assign_to_gpu(gpu=0, ps_dev="/device:CPU:0"):
             return "/gpu:%d" % gpu
     return _assign
 
+def sum_grads(a, b):
+    # sum of two gradients of the same variable, None meaning no gradient
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if isinstance(a, tf.IndexedSlices) and isinstance(b, tf.IndexedSlices):
+        # stays sparse, duplicate rows are summed by whoever applies it
+        return tf.IndexedSlices(tf.concat([a.values, b.values], 0), tf.concat([a.indices, b.indices], 0), a.dense_shape)
+    return tf.convert_to_tensor(a) + tf.convert_to_tensor(b)
+
+def flatten_grads(grads, params):
+    # one flat float32 vector of all gradients, zeros for the params without one
+    return tf.concat([tf.reshape(tf.zeros_like(p) if g is None else tf.convert_to_tensor(g), [-1])
+                      for g, p in zip(grads, params)], 0)
+
+def unflatten_grads(flat, params):
+    # inverse of flatten_grads
+    sizes = [int(np.prod(shape_list(p))) for p in params]
+    return [tf.reshape(g, shape_list(p)) for g, p in zip(tf.split(flat, sizes), params)]
+
+def merge_rows(g):
+    # IndexedSlices g with the values of repeated indices summed, each row once, so that its norm is the norm
+    # of the dense gradient
+    idx, pos = tf.unique(g.indices)
+    return tf.IndexedSlices(tf.unsorted_segment_sum(g.values, pos, tf.shape(idx)[0]), idx, g.dense_shape)
+
 def average_grads(tower_grads):
     def average_dense(grad_and_vars):
         if len(grad_and_vars) == 1:
@@ -162,7 +323,7 @@ def average_grads(tower_grads):
 
     def average_sparse(grad_and_vars):
         if len(grad_and_vars) == 1:
-            return grad_and_vars[0][0]
+            return merge_rows(grad_and_vars[0][0])
 
         indices = []
         values = []
@@ -170,8 +331,8 @@ def average_grads(tower_grads):
             indices += [g.indices]
             values += [g.values]
         indices = tf.concat(indices, 0)
-        values = tf.concat(values, 0)
-        return tf.IndexedSlices(values, indices, grad_and_vars[0][0].dense_shape)
+        values = tf.concat(values, 0) / len(grad_and_vars)
+        return merge_rows(tf.IndexedSlices(values, indices, grad_and_vars[0][0].dense_shape))
 
     average_grads = []
     for grad_and_vars in zip(*tower_grads):